@@ -2,21 +2,33 @@
 Python Advanced Licensing System server
 (Main Fastapi App configuration module)
 """
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .routers import admin, user
-from . import loggers, db, config
+from . import loggers, db, config, cache
 from .access import create_default_user_if_not_exists
+from .licensing import write_behind
 
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):  # pylint: disable=unused-argument
     """Lifespan of FastAPI application"""
-    await db.global_init(config.DB_USER, config.DB_PASSWORD, config.DB_HOST, config.DB_NAME)
+    await db.global_init(config.DB_USER, config.DB_PASSWORD, config.DB_HOST, config.DB_NAME,
+                         config.DB_REPLICA_HOST)
     await create_default_user_if_not_exists()
+    tasks = [asyncio.create_task(cache.listen_invalidations())]
+    if config.WRITE_BEHIND:
+        tasks.append(asyncio.create_task(write_behind.flush_forever()))
+    if config.DB_REPLICA_HOST:
+        tasks.append(asyncio.create_task(db.heartbeat_forever()))
     yield
+    for task in tasks:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
 
 
 app = FastAPI(lifespan=lifespan)
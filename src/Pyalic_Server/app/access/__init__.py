@@ -6,7 +6,7 @@ from sqlalchemy import func
 
 from .. import config
 from ..db import models, create_session
-from .auth import get_password_hash
+from .auth import hash_password
 from .permissions import SUPERUSER
 
 
@@ -20,7 +20,7 @@ async def create_default_user_if_not_exists():
         r = await session.execute(select(func.count()).select_from(models.User))  # pylint: disable=not-callable
         if r.scalar() == 0:  # If not exists
             u = models.User(username=config.DEFAULT_USER,
-                            hashed_password=get_password_hash(config.DEFAULT_PASSWORD),
+                            hashed_password=await hash_password(config.DEFAULT_PASSWORD),
                             permissions=SUPERUSER)
             session.add(u)
         await session.commit()
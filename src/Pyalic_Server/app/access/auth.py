@@ -1,7 +1,12 @@
 """
 Manage Oauth2
 """
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import timedelta, datetime
+from time import time
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -10,8 +15,11 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 
 from ..db import models, session_dep
+from .. import config
+from ..cache import TTLCache, on_invalidation, invalidate
 from ..config import SECRET_KEY
 from ..schema import TokenData, User
+from .permissions import VerifiablePermissions
 
 ALGORITHM = "HS256"
 TOKEN_LIFETIME = 15  # Minutes
@@ -19,6 +27,47 @@ TOKEN_LIFETIME = 15  # Minutes
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="admin/token")
 
+# bcrypt takes hundreds of milliseconds of CPU (releasing GIL), so it runs in a few threads not blocking event loop
+_hashing_executor = ThreadPoolExecutor(max_workers=config.PASSWORD_HASHING_WORKERS, thread_name_prefix="bcrypt")
+_hashing_slots = asyncio.Semaphore(config.PASSWORD_HASHING_WORKERS)
+_hashing_stats = {"running": 0, "queued": 0}
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Authenticated user with everything needed to check his permissions"""
+    id: int
+    username: str
+    permissions: VerifiablePermissions
+    owned_products: frozenset[int]  # IDs of products
+    expires: float  # Timestamp when token expires
+
+    def size(self) -> int:
+        """Approximate size of object in memory (flags of permissions are shared by all principals, so not counted)"""
+        return sys.getsizeof(self) + sys.getsizeof(vars(self)) + sys.getsizeof(self.username) + \
+            sys.getsizeof(self.permissions) + sys.getsizeof(vars(self.permissions)) + \
+            sys.getsizeof(self.owned_products) + sum(sys.getsizeof(p) for p in self.owned_products)
+
+
+# Token -> Principal
+principal_cache = TTLCache(config.PRINCIPAL_CACHE_SIZE, config.PRINCIPAL_CACHE_MAX_BYTES, config.PRINCIPAL_CACHE_TTL)
+
+
+def _invalidate_user(user_id: str | None):
+    if user_id is None:
+        principal_cache.clear()
+        return
+    principal_cache.pop_where(lambda _, principal: principal.id == int(user_id))
+
+
+on_invalidation("user", _invalidate_user)
+
+
+async def invalidate_user(user_id: int):
+    """Drop cached principal of user in all workers (must be called when user or his products are changed)"""
+    await invalidate("user", user_id)
+
+
 CredentialsException = HTTPException(
     status_code=status.HTTP_401_UNAUTHORIZED,
     detail="Wrong credentials",
@@ -40,6 +89,38 @@ def check_password(password: str, hashed: str) -> bool:
     return pwd_context.verify(password, hashed)
 
 
+async def _run_hashing(func, *args):
+    """Run password hashing function in thread pool, counting calls waiting for free thread"""
+    _hashing_stats["queued"] += 1
+    try:
+        await _hashing_slots.acquire()
+    finally:
+        _hashing_stats["queued"] -= 1
+    _hashing_stats["running"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hashing_executor, func, *args)
+    finally:
+        _hashing_stats["running"] -= 1
+        _hashing_slots.release()
+
+
+async def hash_password(password: str) -> str:
+    """`get_password_hash` not blocking event loop"""
+    return await _run_hashing(get_password_hash, password)
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    """`check_password` not blocking event loop"""
+    return await _run_hashing(check_password, password, hashed)
+
+
+def hashing_stats() -> dict[str, int]:
+    """
+    :return: Threads hashing passwords and calls waiting for free thread in current worker
+    """
+    return {"workers": config.PASSWORD_HASHING_WORKERS, **_hashing_stats}
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     """
     Create JWT token
@@ -67,17 +148,23 @@ async def authenticate_user(username: str, password: str, session: AsyncSession)
     user = r.scalar_one_or_none()
     if not user:  # User doesn't exist
         return False
-    if not check_password(password, user.hashed_password):  # Wrong password
+    if not await verify_password(password, user.hashed_password):  # Wrong password
         return False
     return User(username=user.username, id=user.id)
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme),
-                           session: AsyncSession = Depends(session_dep)) -> User:
+async def get_principal(token: str = Depends(oauth2_scheme),
+                        session: AsyncSession = Depends(session_dep)) -> Principal:
     """
-    Dependency checking if the user is authenticated and getting his scheme
-    :return: `User` scheme
+    Dependency checking if the user is authenticated and getting his permissions and products.
+    FastAPI resolves it once per request, and it's cached by token for `PRINCIPAL_CACHE_TTL` seconds
+    :return: `Principal` of the user
     """
+    principal = principal_cache.get(token)
+    if principal is not None and principal.expires > time():
+        return principal
+    # User may be changed while he's read, so the principal is cached only if nothing was invalidated meanwhile
+    generation = principal_cache.generation
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])  # Decode payload
         username: str = payload.get("sub")
@@ -86,9 +173,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme),
         token_data = TokenData(username=username)
     except JWTError as exc:  # Error while decoding
         raise CredentialsException from exc
-    # Get user from DB
-    r = await session.execute(select(models.User).filter_by(username=token_data.username))
-    user = r.scalar_one_or_none()
+    # Get user and IDs of his products from DB
+    r = await session.execute(select(models.User.id, models.User.username, models.User.permissions)
+                              .filter_by(username=token_data.username))
+    user = r.one_or_none()
     if user is None:  # If there's no such user, throw exception
         raise CredentialsException
-    return User(username=user.username, id=user.id)
+    r = await session.execute(select(models.user_product_table.c.product_id)
+                              .where(models.user_product_table.c.user_id == user.id))
+    owned_products = frozenset(r.scalars())
+    principal = Principal(id=user.id, username=user.username,
+                          permissions=VerifiablePermissions(user.id, user.permissions, owned_products),
+                          owned_products=owned_products, expires=payload.get("exp", float("inf")))
+    principal_cache.set(token, principal, principal.size(), generation)
+    return principal
+
+
+async def get_current_user(principal: Principal = Depends(get_principal)) -> User:
+    """
+    Dependency checking if the user is authenticated and getting his scheme
+    :return: `User` scheme
+    """
+    return User(username=principal.username, id=principal.id)
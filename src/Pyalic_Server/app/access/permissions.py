@@ -1,6 +1,9 @@
 """
 Interaction with permissions of Users
 """
+from enum import IntFlag, auto
+from functools import lru_cache
+
 from ..db import models  # pylint: disable=cyclic-import
 
 DEFAULT_PERMISSIONS = "manage_own_products,manage_own_users"
@@ -13,8 +16,56 @@ class InvalidPermissionsString(Exception):
     """
 
 
-ALL_PERMISSIONS = ['superuser', 'manage_own_products', 'manage_other_products', 'read_other_products',
-                   'create_users', 'manage_own_users', 'manage_other_users']
+class Permission(IntFlag):
+    """Bit of permissions mask"""
+    SUPERUSER = auto()
+    MANAGE_OWN_PRODUCTS = auto()
+    MANAGE_OTHER_PRODUCTS = auto()
+    READ_OTHER_PRODUCTS = auto()
+    CREATE_USERS = auto()
+    MANAGE_OWN_USERS = auto()
+    MANAGE_OTHER_USERS = auto()
+
+
+ALL_PERMISSIONS = [p.name.lower() for p in Permission]
+_BY_NAME = {p.name.lower(): p for p in Permission}
+
+# Permissions granted implicitly by having another one
+_IMPLIES = {
+    Permission.SUPERUSER: Permission.MANAGE_OTHER_PRODUCTS | Permission.CREATE_USERS | Permission.MANAGE_OTHER_USERS,
+    Permission.MANAGE_OTHER_PRODUCTS: Permission.READ_OTHER_PRODUCTS,
+    Permission.READ_OTHER_PRODUCTS: Permission.MANAGE_OWN_PRODUCTS,
+    Permission.CREATE_USERS: Permission.MANAGE_OWN_USERS,
+    Permission.MANAGE_OTHER_USERS: Permission.MANAGE_OWN_USERS,
+}
+
+
+def _closure(permission: Permission) -> Permission:
+    """Permission with all permissions implied by it (transitively)"""
+    mask = permission
+    for implied in _IMPLIES.get(permission, Permission(0)):
+        mask |= _closure(implied)
+    return mask
+
+
+_EFFECTIVE = {p: _closure(p) for p in Permission}
+
+
+@lru_cache(maxsize=1024)
+def _compile(s: str) -> tuple[Permission, Permission]:
+    """
+    Parse permissions string (users share a few distinct ones, so it's cached)
+    :return: Granted permissions and them with implied ones
+    :raise InvalidPermissionsString: String has non-existent permission
+    """
+    granted = effective = Permission(0)
+    for el in s.split(','):
+        if el and el not in _BY_NAME:
+            raise InvalidPermissionsString(el)
+        if el.strip():
+            granted |= _BY_NAME[el.strip()]
+            effective |= _EFFECTIVE[_BY_NAME[el.strip()]]
+    return granted, effective
 
 
 # pylint: disable=C0116
@@ -29,45 +80,41 @@ class Permissions:
         User's permissions class
         :param s: Permissions string
         """
-        self._validate(s)
-        self._permissions = [el.strip() for el in s.split(',') if el.strip()]
-
-    @staticmethod
-    def _validate(s: str):
-        for el in s.split(','):
-            if el and el not in ALL_PERMISSIONS:
-                raise InvalidPermissionsString(el)
+        self._granted, self._effective = _compile(s)
 
     def __str__(self) -> str:
-        return ','.join(self._permissions)
+        return ','.join(self)
 
     def __iter__(self):
-        return iter(self._permissions)
+        return (p.name.lower() for p in Permission if p in self._granted)
 
     def __contains__(self, item):
-        return self._permissions.__contains__(item)
+        return item in _BY_NAME and _BY_NAME[item] in self._granted
+
+    def exceeds(self, other: 'Permissions') -> bool:
+        """Whether any permission is granted explicitly here but not in other"""
+        return bool(self._granted & ~other._granted)  # pylint: disable=protected-access
 
     def is_superuser(self) -> bool:
-        return 'superuser' in self._permissions
+        return Permission.SUPERUSER in self._granted
 
     def can_manage_own_products(self) -> bool:
-        return 'manage_own_products' in self._permissions or self.can_read_other_products() or self.is_superuser()
+        return Permission.MANAGE_OWN_PRODUCTS in self._effective
 
     def can_manage_other_products(self) -> bool:
-        return 'manage_other_products' in self._permissions or self.is_superuser()
+        return Permission.MANAGE_OTHER_PRODUCTS in self._effective
 
     def can_read_other_products(self) -> bool:
-        return 'read_other_products' in self._permissions or self.can_manage_other_products() or self.is_superuser()
+        return Permission.READ_OTHER_PRODUCTS in self._effective
 
     def can_create_users(self) -> bool:
-        return 'create_users' in self._permissions or self.is_superuser()
+        return Permission.CREATE_USERS in self._effective
 
     def can_manage_own_users(self) -> bool:
-        return 'manage_own_users' in self._permissions or self.can_create_users() or self.can_manage_other_users() \
-            or self.is_superuser()
+        return Permission.MANAGE_OWN_USERS in self._effective
 
     def can_manage_other_users(self) -> bool:
-        return 'manage_other_users' in self._permissions or self.is_superuser()
+        return Permission.MANAGE_OTHER_USERS in self._effective
 
 
 class VerifiablePermissions(Permissions):
@@ -75,21 +122,27 @@ class VerifiablePermissions(Permissions):
     Interpretation of permissions where realized logic of what actions exactly you are able to perform
     """
 
-    def __init__(self, u: 'models.User'):
-        super().__init__(u.permissions)
-        self._u = u
+    def __init__(self, user_id: int, s: str, owned_products: frozenset[int]):
+        """
+        :param user_id: ID of user performing actions
+        :param s: Permissions string of the user
+        :param owned_products: IDs of products the user owns
+        """
+        super().__init__(s)
+        self._user_id = user_id
+        self._owned_products = owned_products
 
     def able_get_product(self, p: 'models.Product') -> bool:
-        return (self.can_manage_own_products() and p in self._u.owned_products) or \
-            (self.can_read_other_products() and p not in self._u.owned_products)
+        return (self.can_manage_own_products() and p.id in self._owned_products) or \
+            (self.can_read_other_products() and p.id not in self._owned_products)
 
     def able_edit_product(self, p: 'models.Product') -> bool:
-        return (self.can_manage_own_products() and p in self._u.owned_products) or \
-            (self.can_manage_other_products() and p not in self._u.owned_products)
+        return (self.can_manage_own_products() and p.id in self._owned_products) or \
+            (self.can_manage_other_products() and p.id not in self._owned_products)
 
     def able_delete_product(self, p: 'models.Product') -> bool:
-        return (self.can_manage_own_products() and p in self._u.owned_products) or \
-            (self.can_manage_other_products() and p not in self._u.owned_products)
+        return (self.can_manage_own_products() and p.id in self._owned_products) or \
+            (self.can_manage_other_products() and p.id not in self._owned_products)
 
     def able_add_product(self) -> bool:
         return self.can_manage_own_products()
@@ -99,9 +152,8 @@ class VerifiablePermissions(Permissions):
             perm_obj = Permissions(permissions)
         except InvalidPermissionsString:
             return False
-        for p in perm_obj:
-            if p not in self._u.get_permissions() and not self.is_superuser():
-                return False  # If someone tries to abuse his permissions and escalate privileges
+        if perm_obj.exceeds(self) and not self.is_superuser():
+            return False  # If someone tries to abuse his permissions and escalate privileges
         return self.can_create_users()
 
     def able_edit_user(self, u: 'models.User', permissions: str | None = None) -> bool:
@@ -110,18 +162,17 @@ class VerifiablePermissions(Permissions):
                 perm_obj = Permissions(permissions)
             except InvalidPermissionsString:
                 return False
-            for p in perm_obj:
-                if p not in self._u.get_permissions() and not self.is_superuser():
-                    return False  # If someone tries to abuse his permissions and escalate privileges
-        if u.master != self._u:  # If it's not current users product
+            if perm_obj.exceeds(self) and not self.is_superuser():
+                return False  # If someone tries to abuse his permissions and escalate privileges
+        if u.master_id != self._user_id:  # If it's not current users product
             # Requires permission to manage others products
             return self.can_manage_other_users()
         return self.can_manage_own_users()
 
     def able_delete_user(self, u: 'models.User') -> bool:
-        if u == self._u:
+        if u.id == self._user_id:
             return False  # You cannot delete yourself
-        if u.master != self._u:
+        if u.master_id != self._user_id:
             # If you want to delete the user you don't own, required appropriate permission
             return self.can_manage_other_users()
         return self.can_manage_own_users()
@@ -0,0 +1,286 @@
+"""
+Bulk operations: import of signatures and export of everything
+"""
+import codecs
+import csv
+import io
+import json
+import secrets
+from dataclasses import dataclass, field
+from datetime import datetime
+from math import log2
+from typing import AsyncIterator
+
+from sqlalchemy import BigInteger, Boolean, Column, MetaData, Select, Table, Text, case, literal, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import config, schema
+from .db import models, create_session
+from .loggers import logger
+
+IMPORT_COLUMNS = ("license_key", "additional_content", "comment", "activate")
+MAX_REPORTED = 1000  # Max conflicting keys and invalid lines listed in report
+KEY_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # Without characters easily confused (I, O, 0 and 1)
+KEY_PLACEHOLDER = "X"
+MIN_KEY_ENTROPY = 64  # Bits
+STREAM_ERROR = "ERROR: "  # Prefix of the last line of streamed response if it is incomplete
+_TRUE = {"1", "true", "t", "yes", "y"}
+_FALSE = {"", "0", "false", "f", "no", "n"}
+
+# Imported rows are copied here firstly, then merged into signatures
+_staging = Table("import_signatures", MetaData(),
+                 Column("license_key", Text), Column("additional_content", Text), Column("comment", Text),
+                 Column("activate", Boolean),
+                 prefixes=["TEMPORARY"], postgresql_on_commit="DROP")
+
+
+class InvalidRecordException(ValueError):
+    """Record of imported file can't be interpreted as signature"""
+
+
+@dataclass
+class ImportReport:
+    """Result of import of signatures"""
+    imported: int = 0
+    conflicts: int = 0  # Keys which already exist (or are repeated in the file)
+    conflicting_keys: list[str] = field(default_factory=list)
+    invalid: int = 0
+    invalid_lines: list[int] = field(default_factory=list)
+
+
+async def _iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split stream of UTF-8 encoded bytes into lines (with line endings)"""
+    # Byte order mark is skipped, Excel writes it at the beginning of "CSV UTF-8" files
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in stream:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            yield line + "\n"
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+async def iter_csv(stream: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | None]]:
+    """
+    Parse CSV with header row
+    :param stream: Content of file
+    :return: Line number and record of every row (`None` if row is malformed)
+    """
+    header = None
+    record, start = "", 0
+    number = 0
+    async for line in _iter_lines(stream):
+        number += 1
+        if not record:
+            start = number
+        record += line
+        if record.count('"') % 2:  # Quoted field continues on the next line
+            continue
+        try:
+            row = next(csv.reader([record]), [])
+        except csv.Error:
+            row = None
+        record = ""
+        if row is None:
+            yield start, None
+            continue
+        if not row:
+            continue
+        if header is None:
+            header = [name.strip() for name in row]
+            continue
+        yield start, dict(zip(header, row)) if len(row) == len(header) else None
+    if record:
+        yield start, None  # Quote is never closed
+
+
+async def iter_ndjson(stream: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | None]]:
+    """
+    Parse newline-delimited JSON
+    :param stream: Content of file
+    :return: Line number and record of every line (`None` if line isn't a JSON object)
+    """
+    number = 0
+    async for line in _iter_lines(stream):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def _parse_record(record: dict | None) -> tuple[str, str, str, bool]:
+    """
+    :return: Values of `IMPORT_COLUMNS`
+    :raise InvalidRecordException: Record is malformed or has no license key
+    """
+    if record is None:
+        raise InvalidRecordException()
+    license_key = record.get("license_key")
+    additional_content = record.get("additional_content") or ""
+    comment = record.get("comment") or ""
+    activate = record.get("activate")
+    if not isinstance(license_key, str) or not license_key or \
+            not isinstance(additional_content, str) or not isinstance(comment, str):
+        raise InvalidRecordException()
+    if isinstance(activate, str):
+        if activate.strip().lower() not in _TRUE | _FALSE:
+            raise InvalidRecordException()
+        activate = activate.strip().lower() in _TRUE
+    elif activate is None:
+        activate = False
+    elif not isinstance(activate, bool):
+        raise InvalidRecordException()
+    return license_key, additional_content, comment, activate
+
+
+async def _merge_chunk(rows: list[tuple[str, str, str, bool]], product_id: int, session: AsyncSession) -> set[str]:
+    """
+    Copy rows into staging table and insert new keys into signatures in one transaction
+    :param rows: Values of `IMPORT_COLUMNS`
+    :return: License keys inserted
+    """
+    conn = await session.connection()
+    await conn.run_sync(_staging.create)
+    raw = await conn.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(_staging.name, records=rows, columns=IMPORT_COLUMNS)
+    r = await session.execute(insert(models.Signature).from_select(
+        ["license_key", "additional_content", "comment", "product_id", "activation_date"],
+        select(_staging.c.license_key, _staging.c.additional_content, _staging.c.comment,
+               literal(product_id, BigInteger), case((_staging.c.activate, datetime.utcnow()), else_=None))
+    ).on_conflict_do_nothing(index_elements=["license_key"]).returning(models.Signature.license_key))
+    inserted = set(r.scalars())
+    await session.commit()
+    return inserted
+
+
+async def _import_chunk(rows: list[tuple[str, str, str, bool]], product_id: int, session: AsyncSession,
+                        report: ImportReport):
+    """Merge rows into signatures and account conflicts in report"""
+    inserted = await _merge_chunk(rows, product_id, session)
+    report.imported += len(inserted)
+    for license_key, *_ in rows:
+        if license_key in inserted:
+            inserted.remove(license_key)  # Repeated key is a conflict
+            continue
+        report.conflicts += 1
+        if len(report.conflicting_keys) < MAX_REPORTED:
+            report.conflicting_keys.append(license_key)
+
+
+async def import_signatures(product_id: int, records: AsyncIterator[tuple[int, dict | None]],
+                            session: AsyncSession) -> ImportReport:
+    """
+    Import signatures of product in chunks of `IMPORT_CHUNK_SIZE`, every one in its own transaction.
+    Keys which already exist are left untouched and reported as conflicts
+    :param product_id: ID of product
+    :param records: Line number and record of every signature (see `iter_csv` and `iter_ndjson`)
+    :param session: AsyncSession of database
+    """
+    report = ImportReport()
+    rows = []
+    async for number, record in records:
+        try:
+            rows.append(_parse_record(record))
+        except InvalidRecordException:
+            report.invalid += 1
+            if len(report.invalid_lines) < MAX_REPORTED:
+                report.invalid_lines.append(number)
+            continue
+        if len(rows) >= config.IMPORT_CHUNK_SIZE:
+            await _import_chunk(rows, product_id, session, report)
+            rows = []
+    if rows:
+        await _import_chunk(rows, product_id, session, report)
+    return report
+
+
+def key_entropy(key_format: str) -> float:
+    """Bits of randomness in keys of format"""
+    return key_format.count(KEY_PLACEHOLDER) * log2(len(KEY_ALPHABET))
+
+
+def generate_key(key_format: str) -> str:
+    """
+    Generate cryptographically random key
+    :param key_format: Template of key, every `KEY_PLACEHOLDER` is replaced by random character of `KEY_ALPHABET`
+    """
+    # Alphabet has 32 characters, so taking 5 lower bits of random byte doesn't skew distribution
+    rand = iter(secrets.token_bytes(key_format.count(KEY_PLACEHOLDER)))
+    return "".join(KEY_ALPHABET[next(rand) & 31] if c == KEY_PLACEHOLDER else c for c in key_format)
+
+
+async def generate_signatures(payload: schema.GenerateSignatures) -> AsyncIterator[str]:
+    """
+    Generate signatures with random keys in chunks of `IMPORT_CHUNK_SIZE`, every one in its own transaction.
+    Colliding keys are just generated again.
+    Session is opened here, because it must live as long as the response is being sent
+    :param payload: Product, quantity and format of keys and content of signatures
+    :return: Created keys (one per line) of every chunk, followed by line starting with `STREAM_ERROR` if
+    fewer keys than requested were generated (format is exhausted or database failed)
+    """
+    left = payload.count
+    try:
+        async with create_session() as session:
+            while left > 0:
+                keys = {generate_key(payload.key_format) for _ in range(min(left, config.IMPORT_CHUNK_SIZE))}
+                inserted = await _merge_chunk([(key, payload.additional_content, payload.comment, payload.activate)
+                                               for key in keys], payload.product_id, session)
+                if not inserted:  # Nothing left to generate in such format
+                    yield f"{STREAM_ERROR}Generated {payload.count - left} of {payload.count} signatures, " \
+                          f"no more unique keys of this format\n"
+                    return
+                left -= len(inserted)
+                yield "".join(key + "\n" for key in inserted)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        # Status code is already sent, so the only way to report failure is the content itself
+        await logger.exception(f"Generation of signatures failed: {exc!r}")
+        yield f"{STREAM_ERROR}Generated {payload.count - left} of {payload.count} signatures, generation failed\n"
+
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _format_rows(rows, keys: list[str], fmt: str) -> str:
+    """Format rows as CSV or NDJSON lines"""
+    if fmt == "ndjson":
+        return "".join(json.dumps({key: _export_value(value) for key, value in zip(keys, row)}) + "\n"
+                       for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([_export_value(value) for value in row] for row in rows)
+    return buffer.getvalue()
+
+
+async def export_rows(query: Select, fmt: str) -> AsyncIterator[str]:
+    """
+    Stream results of query fetched through server-side cursor, `EXPORT_FETCH_SIZE` rows at once,
+    so memory usage doesn't depend on quantity of rows.
+    Session is opened here, because it must live as long as the response is being sent
+    :param query: Query to export results of
+    :param fmt: "csv" (with header) or "ndjson"
+    :return: Chunks of formatted rows. If export fails, the last line is `{"error": ...}` in NDJSON
+    or starts with `STREAM_ERROR` in CSV, so incomplete file can be told from complete one
+    """
+    exported = 0
+    try:
+        async with create_session(read_only=True) as session:
+            result = await session.stream(query.execution_options(yield_per=config.EXPORT_FETCH_SIZE))
+            keys = list(result.keys())
+            if fmt == "csv":
+                yield _format_rows([keys], keys, fmt)
+            async for rows in result.partitions():
+                yield _format_rows(rows, keys, fmt)
+                exported += len(rows)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        # Status code is already sent, so the only way to report failure is the content itself
+        await logger.exception(f"Export failed after {exported} rows: {exc!r}")
+        error = f"Export failed after {exported} rows"
+        yield json.dumps({"error": error}) + "\n" if fmt == "ndjson" else f"{STREAM_ERROR}{error}\n"
@@ -0,0 +1,150 @@
+"""
+In-process caches and their invalidation across all workers
+"""
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Callable, Hashable
+
+from redis.exceptions import RedisError
+
+from .licensing import redis
+from .loggers import logger
+
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+
+class TTLCache:  # pylint: disable=too-many-instance-attributes
+    """
+    LRU cache with expiring entries, bounded by quantity of entries and their approximate size
+    """
+
+    def __init__(self, max_entries: int, max_size: int, ttl: float):
+        """
+        :param max_entries: Maximum quantity of entries (`0` disables cache)
+        :param max_size: Maximum summary size of entries in bytes
+        :param ttl: Lifetime of entry in seconds
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[Any, int, float]] = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0  # Incremented by every invalidation (`pop_where` and `clear`)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any | None:
+        """
+        Get cached value
+        :return: Value or `None` if there's no such entry, or it's expired
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[2] < monotonic():
+            if entry is not None:
+                self.pop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, size: int = 0, generation: int | None = None):
+        """
+        Put value to cache evicting least recently used entries if needed
+        :param key: Key of entry
+        :param value: Value of entry (mustn't be `None`)
+        :param size: Approximate size of entry in bytes
+        :param generation: `generation` of cache taken before value was loaded. If entries were invalidated since
+        then, the value may be already stale, so it isn't cached
+        """
+        if self.max_entries <= 0 or size > self.max_size:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        self.pop(key)
+        self._entries[key] = (value, size, monotonic() + self.ttl)
+        self._size += size
+        while len(self._entries) > self.max_entries or self._size > self.max_size:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._size -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        """Remove entry if it exists"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def pop_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """Remove all entries matching predicate"""
+        self.generation += 1
+        for key in [k for k, (v, _, _) in self._entries.items() if predicate(k, v)]:
+            self.pop(key)
+
+    def clear(self):
+        """Remove all entries"""
+        self.generation += 1
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self) -> dict[str, int]:
+        """
+        :return: Counters describing usage of cache
+        """
+        return {"entries": len(self._entries), "size": self._size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+_invalidation_handlers: dict[str, list[Callable[[str | None], None]]] = {}
+
+
+def on_invalidation(namespace: str, handler: Callable[[str | None], None]):
+    """
+    Register handler of invalidation messages
+    :param namespace: Namespace of messages (i.e. type of invalidated object)
+    :param handler: Function getting argument of message (i.e. ID of invalidated object), or `None` if
+    everything in namespace must be invalidated
+    """
+    _invalidation_handlers.setdefault(namespace, []).append(handler)
+
+
+def _apply_invalidation(namespace: str, arg: str | None):
+    for handler in _invalidation_handlers.get(namespace, []):
+        handler(arg)
+
+
+async def invalidate(namespace: str, arg: Any):
+    """
+    Invalidate cached objects in current worker and broadcast it to other ones
+    :param namespace: Namespace of message (i.e. type of invalidated object)
+    :param arg: Argument of message (i.e. ID of invalidated object)
+    """
+    _apply_invalidation(namespace, str(arg))
+    try:
+        await redis.publish(INVALIDATION_CHANNEL, f"{namespace}:{arg}")
+    except RedisError as exc:
+        await logger.error(f"Failed to broadcast invalidation of {namespace}:{arg}: {exc}")
+
+
+async def listen_invalidations():
+    """
+    Apply invalidation messages broadcast by all workers (runs until cancelled)
+    """
+    while True:
+        try:
+            async with redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Messages might be lost while we were not subscribed
+                for namespace in _invalidation_handlers:
+                    _apply_invalidation(namespace, None)
+                async for message in pubsub.listen():
+                    namespace, arg = message["data"].decode().split(":", 1)
+                    _apply_invalidation(namespace, arg)
+        except RedisError as exc:
+            await logger.error(f"Lost subscription to cache invalidations: {exc}")
+            await asyncio.sleep(1)
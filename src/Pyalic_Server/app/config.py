@@ -9,6 +9,19 @@ DB_HOST = environ.get('DB_HOST')
 DB_USER = environ.get('DB_USER')
 DB_PASSWORD = environ.get('DB_PASSWORD')
 DB_NAME = environ.get('DB_NAME')
+# Connections pool of every worker (0 disables pooling, so every session opens its own connection)
+DB_POOL_SIZE = int(environ.get('DB_POOL_SIZE', default=5))
+DB_POOL_MAX_OVERFLOW = int(environ.get('DB_POOL_MAX_OVERFLOW', default=10))
+DB_POOL_TIMEOUT = float(environ.get('DB_POOL_TIMEOUT', default=30))  # Seconds to wait for free connection
+DB_POOL_PRE_PING = bool(int(environ.get('DB_POOL_PRE_PING', default=1)))
+DB_POOL_RECYCLE = int(environ.get('DB_POOL_RECYCLE', default=1800))  # Seconds before connection is reopened
+DB_STATEMENT_CACHE_SIZE = int(environ.get('DB_STATEMENT_CACHE_SIZE', default=100))  # Prepared statements per connection
+# Replica of the database serving read-only handlers (same user, password and name), not used if unset
+DB_REPLICA_HOST = environ.get('DB_REPLICA_HOST')
+DB_REPLICA_MAX_LAG = float(environ.get('DB_REPLICA_MAX_LAG', default=1))  # Seconds, primary is read if lag is greater
+DB_REPLICA_LAG_CHECK_PERIOD = float(environ.get('DB_REPLICA_LAG_CHECK_PERIOD', default=1))  # Seconds
+# Seconds between heartbeats written to primary to measure lag with (must be shorter than DB_REPLICA_MAX_LAG)
+DB_REPLICA_HEARTBEAT_PERIOD = float(environ.get('DB_REPLICA_HEARTBEAT_PERIOD', default=0.5))
 ACCESS_TOKEN = '123'
 
 REDIS_HOST = environ.get('REDIS_HOST')
@@ -17,9 +30,32 @@ REDIS_PASSWORD = environ.get('REDIS_PASSWORD')
 REDIS_DB = environ.get('REDIS_DB')
 
 SESSION_ALIVE_PERIOD = int(environ.get('SESSION_ALIVE_PERIOD', default=4))
+BATCH_LIMIT = int(environ.get('BATCH_LIMIT', default=100))  # Max items in one batch request
+KEEPALIVE_BATCH_LIMIT = int(environ.get('KEEPALIVE_BATCH_LIMIT', default=1000))  # Max sessions in one keep-alive
+
+DELETE_CHUNK_SIZE = int(environ.get('DELETE_CHUNK_SIZE', default=5000))  # Signatures deleted per transaction
+IMPORT_CHUNK_SIZE = int(environ.get('IMPORT_CHUNK_SIZE', default=10000))  # Signatures imported per transaction
+GENERATE_LIMIT = int(environ.get('GENERATE_LIMIT', default=1000000))  # Max signatures generated at once
+EXPORT_FETCH_SIZE = int(environ.get('EXPORT_FETCH_SIZE', default=1000))  # Rows fetched from cursor at once
+
+# Admit checks after reservation in redis and write installations to database in background
+WRITE_BEHIND = bool(int(environ.get('WRITE_BEHIND', default=0)))
+WRITE_BEHIND_BATCH_SIZE = int(environ.get('WRITE_BEHIND_BATCH_SIZE', default=1000))  # Installations per flush
+WRITE_BEHIND_FLUSH_INTERVAL = float(environ.get('WRITE_BEHIND_FLUSH_INTERVAL', default=1))  # Seconds
+WRITE_BEHIND_CLAIM_IDLE = float(environ.get('WRITE_BEHIND_CLAIM_IDLE', default=60))  # Seconds before replay
+# Seconds to keep installations reserved in redis (must be much longer than flushes may be delayed)
+WRITE_BEHIND_RESERVATION_TTL = int(environ.get('WRITE_BEHIND_RESERVATION_TTL', default=24 * 60 * 60))
+
+LICENSE_CACHE_SIZE = int(environ.get('LICENSE_CACHE_SIZE', default=10000))  # Entries, 0 disables cache
+LICENSE_CACHE_MAX_BYTES = int(environ.get('LICENSE_CACHE_MAX_BYTES', default=16 * 1024 * 1024))
+LICENSE_CACHE_TTL = float(environ.get('LICENSE_CACHE_TTL', default=60))  # Seconds
 
 SECRET_KEY = environ.get('SECRET_KEY')
+PASSWORD_HASHING_WORKERS = int(environ.get('PASSWORD_HASHING_WORKERS', default=2))  # Threads running bcrypt
 ACCESS_TOKEN_EXPIRE_MINUTES = environ.get('ACCESS_TOKEN_EXPIRE_MINUTES', default=30)
+PRINCIPAL_CACHE_SIZE = int(environ.get('PRINCIPAL_CACHE_SIZE', default=1000))  # Tokens, 0 disables cache
+PRINCIPAL_CACHE_MAX_BYTES = int(environ.get('PRINCIPAL_CACHE_MAX_BYTES', default=4 * 1024 * 1024))
+PRINCIPAL_CACHE_TTL = float(environ.get('PRINCIPAL_CACHE_TTL', default=10))  # Seconds
 
 DEFAULT_USER = environ.get('DEFAULT_USER')
 DEFAULT_PASSWORD = environ.get('DEFAULT_PASSWORD')
@@ -1,37 +1,143 @@
 """
 Actions with Database
 """
+import asyncio
+from os import path
+from time import perf_counter, monotonic
 from typing import AsyncIterator
 from contextlib import asynccontextmanager
-from sqlalchemy.ext.asyncio import create_async_engine
+from alembic import command
+from alembic.config import Config as AlembicConfig
+from fastapi import Depends
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection, AsyncEngine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.pool import NullPool
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
+
+from .. import config
+from ..loggers import logger
 
 SqlAlchemyBase = declarative_base()
 
 ENGINE = None
 __FACTORY = None
+REPLICA_ENGINE = None
+__REPLICA_FACTORY = None
+_replica_state = {"checked_at": float("-inf"), "usable": False}  # Result of the last check of replication lag
+
+MIGRATIONS_PATH = path.join(path.dirname(__file__), "migrations")
+BASELINE_REVISION = "0001"  # Schema created by `metadata.create_all` before migrations were introduced
+MIGRATIONS_LOCK = 0x5079616c6963  # Key of advisory lock taken while migrating
+HEARTBEAT_LOCK = 0x5079616c6964  # Key of advisory lock held by the only worker writing heartbeat
+# Seconds since the last transaction replayed by replica was committed on primary (zero if it isn't a replica).
+# Primary commits heartbeat regularly, so it's only fresh while replica keeps streaming WAL.
+# `NULL` if WAL receiver isn't streaming (status is visible to superusers and members of `pg_read_all_stats` only)
+REPLICATION_LAG_QUERY = text("""
+    SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN NOT EXISTS (SELECT FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END""")
+HEARTBEAT_QUERY = text("INSERT INTO heartbeat (id, beat_at) VALUES (1, now()) "
+                       "ON CONFLICT (id) DO UPDATE SET beat_at = EXCLUDED.beat_at")
+TRY_LOCK_QUERY = text("SELECT pg_try_advisory_lock(:key)")
+
+
+class _TimedPoolMixin:  # pylint: disable=too-few-public-methods
+    """Counts checkouts of connections from pool and time spent waiting for them"""
+    checkouts = 0
+    wait_time = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()  # noqa
+        finally:
+            self.checkouts += 1
+            self.wait_time += perf_counter() - start
+
+
+class TimedQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    """Queue pool counting checkouts and wait time"""
 
 
-async def global_init(user, password, hostname, db_name):
+class TimedNullPool(_TimedPoolMixin, NullPool):
+    """Pool without pooling (opens connection on every checkout) counting checkouts and wait time"""
+
+
+def create_engine(user, password, hostname, db_name, pool_size: int = config.DB_POOL_SIZE) -> AsyncEngine:
+    """
+    Create ASYNC PostgreSQL engine configured from `config`
+    :param user: User of DB
+    :param password: Password of DB
+    :param hostname: Address of DB
+    :param db_name: Name of DB
+    :param pool_size: Size of connections pool (`0` disables pooling)
+    """
+    conn_str = f'postgresql+asyncpg://{user}:{password}@{hostname}/{db_name}' \
+               f'?prepared_statement_cache_size={config.DB_STATEMENT_CACHE_SIZE}'
+    if pool_size <= 0:
+        return create_async_engine(conn_str, echo=False, poolclass=TimedNullPool)
+    return create_async_engine(conn_str, echo=False, poolclass=TimedQueuePool, pool_size=pool_size,
+                               max_overflow=config.DB_POOL_MAX_OVERFLOW, pool_timeout=config.DB_POOL_TIMEOUT,
+                               pool_pre_ping=config.DB_POOL_PRE_PING, pool_recycle=config.DB_POOL_RECYCLE)
+
+
+def migrate(connection: Connection):
+    """
+    Upgrade database schema to the latest revision
+    :param connection: Connection in transaction
+    """
+    # Every worker migrates on startup, so let them do it one by one
+    connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATIONS_LOCK})
+    cfg = AlembicConfig()
+    cfg.set_main_option("script_location", MIGRATIONS_PATH)
+    cfg.attributes["connection"] = connection
+    cfg.attributes["target_metadata"] = SqlAlchemyBase.metadata
+    inspector = inspect(connection)
+    if not inspector.has_table("alembic_version") and inspector.has_table("signatures"):
+        command.stamp(cfg, BASELINE_REVISION)
+    command.upgrade(cfg, "head")
+
+
+async def global_init(user, password, hostname, db_name, replica_hostname: str | None = None):
     """
     Globally init ASYNC PostgreSQL DB
     :param user: User of DB
     :param password: Password of DB
     :param hostname: Address of DB
     :param db_name: Name of DB
+    :param replica_hostname: Address of read-only replica of DB (if there is one)
     """
     global __FACTORY  # pylint: disable=W0603
     global ENGINE  # pylint: disable=W0603
+    global __REPLICA_FACTORY  # pylint: disable=W0603
+    global REPLICA_ENGINE  # pylint: disable=W0603
     if __FACTORY:
         return
-    conn_str = f'postgresql+asyncpg://{user}:{password}@{hostname}/{db_name}'
-    ENGINE = create_async_engine(conn_str, echo=False, poolclass=NullPool)
+    ENGINE = create_engine(user, password, hostname, db_name)
     __FACTORY = sessionmaker(bind=ENGINE, class_=AsyncSession, expire_on_commit=False)
+    if replica_hostname:
+        REPLICA_ENGINE = create_engine(user, password, replica_hostname, db_name)
+        __REPLICA_FACTORY = sessionmaker(bind=REPLICA_ENGINE, class_=AsyncSession, expire_on_commit=False)
     async with ENGINE.begin() as conn:
-        # Create all models
-        await conn.run_sync(SqlAlchemyBase.metadata.create_all)
+        # Create or upgrade all models
+        await conn.run_sync(migrate)
+
+
+def pool_stats(engine: AsyncEngine = None) -> dict[str, int | float]:
+    """
+    :param engine: Engine to get counters of (primary one by default)
+    :return: Counters of connections pool of current worker
+    """
+    pool = (engine or ENGINE).pool
+    queued = isinstance(pool, AsyncAdaptedQueuePool)
+    return {"size": pool.size() if queued else 0,
+            "checked_out": pool.checkedout() if queued else 0,
+            "overflow": max(pool.overflow(), 0) if queued else 0,
+            "checkouts": pool.checkouts,
+            "wait_time": pool.wait_time}
 
 
 async def session_dep() -> AsyncIterator[AsyncSession]:
@@ -40,11 +146,80 @@ async def session_dep() -> AsyncIterator[AsyncSession]:
         yield session
 
 
+async def replica_usable() -> bool:
+    """
+    Check if replica is configured and lags behind primary no more than allowed.
+    Lag is checked at most once in `DB_REPLICA_LAG_CHECK_PERIOD` seconds
+    """
+    if __REPLICA_FACTORY is None:
+        return False
+    now = monotonic()
+    if now - _replica_state["checked_at"] < config.DB_REPLICA_LAG_CHECK_PERIOD:
+        return _replica_state["usable"]
+    try:
+        async with REPLICA_ENGINE.connect() as conn:
+            lag = (await conn.execute(REPLICATION_LAG_QUERY)).scalar_one()
+        usable = lag is not None and lag <= config.DB_REPLICA_MAX_LAG
+    except (OSError, SQLAlchemyError):
+        usable = False  # Replica is down, so read from primary
+    _replica_state.update(checked_at=now, usable=usable)
+    return usable
+
+
+async def _write_heartbeat_forever(conn: AsyncConnection):
+    """
+    Commit heartbeat every `DB_REPLICA_HEARTBEAT_PERIOD` seconds
+    :param conn: Connection holding `HEARTBEAT_LOCK`
+    """
+    try:
+        while True:
+            await conn.execute(HEARTBEAT_QUERY)
+            await conn.commit()
+            await asyncio.sleep(config.DB_REPLICA_HEARTBEAT_PERIOD)
+    finally:
+        # Lock lives as long as connection, so it's closed instead of being returned to pool
+        await conn.invalidate()
+
+
+async def heartbeat_forever():
+    """
+    Background task committing heartbeat to primary every `DB_REPLICA_HEARTBEAT_PERIOD` seconds,
+    so replication lag is measured even when nothing else is written.
+    Only the worker holding `HEARTBEAT_LOCK` writes it, others try to take the lock over every period
+    in case that worker is gone
+    """
+    while True:
+        try:
+            async with ENGINE.connect() as conn:
+                if (await conn.execute(TRY_LOCK_QUERY, {"key": HEARTBEAT_LOCK})).scalar_one():
+                    await conn.commit()
+                    await _write_heartbeat_forever(conn)
+        except (OSError, SQLAlchemyError) as exc:
+            await logger.error(f"Failed to write heartbeat: {exc}")
+        await asyncio.sleep(config.DB_REPLICA_HEARTBEAT_PERIOD)
+
+
+async def read_session_dep(session: AsyncSession = Depends(session_dep)) -> AsyncIterator[AsyncSession]:
+    """
+    Create async session for read-only handlers: to replica if it's usable, otherwise to primary
+    (the same session as `session_dep` of this request, so no extra connection is taken)
+    """
+    if not await replica_usable():
+        yield session
+        return
+    async with __REPLICA_FACTORY() as replica_session:  # noqa
+        yield replica_session
+
+
 @asynccontextmanager
-async def create_session() -> AsyncSession:
-    """Create async session to configured database"""
+async def create_session(read_only: bool = False) -> AsyncSession:
+    """
+    Create async session to configured database
+    :param read_only: Session is used only for reading, so replica may serve it if it's usable
+    """
+    factory = __REPLICA_FACTORY if read_only and await replica_usable() else __FACTORY
     try:
-        async with __FACTORY() as session:  # noqa
+        async with factory() as session:  # noqa
             yield session
     finally:
         await session.close()
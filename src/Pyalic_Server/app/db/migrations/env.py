@@ -0,0 +1,33 @@
+"""
+Alembic environment: migrations are applied on startup by `db.global_init` (which passes its connection) or
+from command line with `alembic upgrade head` (run in server directory, credentials are taken from config)
+"""
+import asyncio
+from alembic import context
+from sqlalchemy.engine import Connection
+
+
+def run_migrations(connection: Connection, target_metadata):
+    """Run migrations using existing connection"""
+    context.configure(connection=connection, target_metadata=target_metadata)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_migrations_cli():
+    """Run migrations connecting to configured database"""
+    # pylint: disable=import-outside-toplevel
+    from app import config
+    from app.db import SqlAlchemyBase, create_engine, models  # noqa  # pylint: disable=unused-import
+    engine = create_engine(config.DB_USER, config.DB_PASSWORD, config.DB_HOST, config.DB_NAME, pool_size=0)
+    async with engine.begin() as conn:
+        await conn.run_sync(run_migrations, SqlAlchemyBase.metadata)
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    raise RuntimeError("Offline migrations are not supported")
+if context.config.attributes.get("connection") is not None:
+    run_migrations(context.config.attributes["connection"], context.config.attributes.get("target_metadata"))
+else:
+    asyncio.run(run_migrations_cli())
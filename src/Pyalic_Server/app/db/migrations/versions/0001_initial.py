@@ -0,0 +1,61 @@
+"""Initial schema (as created by `metadata.create_all` before migrations were introduced)
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'products',
+        sa.Column('id', sa.BigInteger(), autoincrement=True, primary_key=True),
+        sa.Column('name', sa.Text(), nullable=False),
+        sa.Column('sig_install_limit', sa.Integer()),
+        sa.Column('sig_sessions_limit', sa.Integer()),
+        sa.Column('sig_period', sa.Interval()),
+        sa.Column('additional_content', sa.Text(), nullable=False),
+    )
+    op.create_table(
+        'users',
+        sa.Column('id', sa.BigInteger(), autoincrement=True, primary_key=True),
+        sa.Column('username', sa.Text(), nullable=False),
+        sa.Column('hashed_password', sa.Text(), nullable=False),
+        sa.Column('permissions', sa.Text(), nullable=False),
+        sa.Column('master_id', sa.BigInteger(), sa.ForeignKey('users.id')),
+    )
+    op.create_table(
+        'signatures',
+        sa.Column('id', sa.BigInteger(), autoincrement=True, primary_key=True),
+        sa.Column('license_key', sa.Text(), nullable=False, unique=True),
+        sa.Column('additional_content', sa.Text(), nullable=False),
+        sa.Column('comment', sa.Text(), nullable=False),
+        sa.Column('activation_date', sa.DateTime()),
+        sa.Column('product_id', sa.BigInteger(), sa.ForeignKey('products.id'), nullable=False),
+    )
+    op.create_table(
+        'installations',
+        sa.Column('id', sa.BigInteger(), autoincrement=True, primary_key=True),
+        sa.Column('fingerprint', sa.Text(), nullable=False),
+        sa.Column('signature_id', sa.BigInteger(), sa.ForeignKey('signatures.id'), nullable=False),
+    )
+    op.create_table(
+        'user_product',
+        sa.Column('user_id', sa.BigInteger(), sa.ForeignKey('users.id'), primary_key=True),
+        sa.Column('product_id', sa.BigInteger(), sa.ForeignKey('products.id'), primary_key=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('user_product')
+    op.drop_table('installations')
+    op.drop_table('signatures')
+    op.drop_table('users')
+    op.drop_table('products')
@@ -0,0 +1,34 @@
+"""Indexes and unique constraints for hot lookups
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Installations used to be registered on every check of keys without installations limit
+    op.execute("DELETE FROM installations a USING installations b "
+               "WHERE a.signature_id = b.signature_id AND a.fingerprint = b.fingerprint AND a.id > b.id")
+    op.create_unique_constraint('uq_installations_signature_id_fingerprint', 'installations',
+                                ['signature_id', 'fingerprint'])
+    op.create_index('ix_signatures_product_id', 'signatures', ['product_id'])
+    op.create_unique_constraint('uq_products_name', 'products', ['name'])
+    op.create_unique_constraint('uq_users_username', 'users', ['username'])
+    op.create_index('ix_users_master_id', 'users', ['master_id'])
+    op.create_index('ix_user_product_product_id', 'user_product', ['product_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_user_product_product_id', 'user_product')
+    op.drop_index('ix_users_master_id', 'users')
+    op.drop_constraint('uq_users_username', 'users')
+    op.drop_constraint('uq_products_name', 'products')
+    op.drop_index('ix_signatures_product_id', 'signatures')
+    op.drop_constraint('uq_installations_signature_id_fingerprint', 'installations')
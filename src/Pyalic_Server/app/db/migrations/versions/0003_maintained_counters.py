@@ -0,0 +1,53 @@
+"""Counters of signatures per product and installations per signature maintained by triggers
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+# Child table, parent table, foreign key, counter column
+COUNTERS = (
+    ("signatures", "products", "product_id", "signatures_count"),
+    ("installations", "signatures", "signature_id", "installations_count"),
+)
+
+
+def upgrade() -> None:
+    op.add_column('products', sa.Column('signatures_count', sa.BigInteger(), server_default='0', nullable=False))
+    op.add_column('signatures', sa.Column('installations_count', sa.BigInteger(), server_default='0',
+                                          nullable=False))
+    for table, parent_table, foreign_key, counter in COUNTERS:
+        # Take the lock first, so nothing is counted twice or missed between backfill and trigger creation
+        op.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+        op.execute(f"UPDATE {parent_table} SET {counter} = c.n FROM "
+                   f"(SELECT {foreign_key}, count(*) AS n FROM {table} GROUP BY {foreign_key}) AS c "
+                   f"WHERE {parent_table}.id = c.{foreign_key}")
+        for operation, transition, sign in (("insert", "NEW", "+"), ("delete", "OLD", "-")):
+            function = f"{table}_count_{operation}"
+            op.execute(f"""
+                CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE {parent_table} SET {counter} = {parent_table}.{counter} {sign} changed.n
+                    FROM (SELECT {foreign_key}, count(*) AS n FROM changed_rows GROUP BY {foreign_key}) AS changed
+                    WHERE {parent_table}.id = changed.{foreign_key};
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql""")
+            op.execute(f"CREATE TRIGGER {function} AFTER {operation.upper()} ON {table} REFERENCING {transition} "
+                       f"TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function}()")
+
+
+def downgrade() -> None:
+    for table, _, _, _ in COUNTERS:
+        for operation in ("insert", "delete"):
+            op.execute(f"DROP TRIGGER IF EXISTS {table}_count_{operation} ON {table}")
+            op.execute(f"DROP FUNCTION IF EXISTS {table}_count_{operation}()")
+    op.drop_column('signatures', 'installations_count')
+    op.drop_column('products', 'signatures_count')
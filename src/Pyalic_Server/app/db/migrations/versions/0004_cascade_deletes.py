@@ -0,0 +1,33 @@
+"""Cascade deletes of products and signatures to rows referencing them
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+# Constraint, table, column, referenced table
+FOREIGN_KEYS = (
+    ("installations_signature_id_fkey", "installations", "signature_id", "signatures"),
+    ("signatures_product_id_fkey", "signatures", "product_id", "products"),
+    ("user_product_product_id_fkey", "user_product", "product_id", "products"),
+)
+
+
+def _recreate_foreign_keys(ondelete: str | None):
+    for name, table, column, referenced in FOREIGN_KEYS:
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(name, table, referenced, [column], ['id'], ondelete=ondelete)
+
+
+def upgrade() -> None:
+    _recreate_foreign_keys("CASCADE")
+
+
+def downgrade() -> None:
+    _recreate_foreign_keys(None)
@@ -0,0 +1,27 @@
+"""Indexes for searching signatures by key prefix, comment and fingerprint
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.create_index('ix_signatures_license_key_pattern', 'signatures', ['license_key'],
+                    postgresql_ops={'license_key': 'text_pattern_ops'})
+    op.create_index('ix_signatures_comment_trgm', 'signatures', ['comment'], postgresql_using='gin',
+                    postgresql_ops={'comment': 'gin_trgm_ops'})
+    op.create_index('ix_installations_fingerprint', 'installations', ['fingerprint'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_installations_fingerprint', 'installations')
+    op.drop_index('ix_signatures_comment_trgm', 'signatures')
+    op.drop_index('ix_signatures_license_key_pattern', 'signatures')
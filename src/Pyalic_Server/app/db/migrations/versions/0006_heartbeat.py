@@ -0,0 +1,23 @@
+"""Heartbeat written to primary to measure replication lag
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('heartbeat',
+                    sa.Column('id', sa.Integer(), primary_key=True),
+                    sa.Column('beat_at', sa.DateTime(), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_table('heartbeat')
@@ -1,14 +1,16 @@
 """SQLAlchemy ORM models placed here"""
-from sqlalchemy import Column, BigInteger, Integer, Interval, Text, DateTime, orm, ForeignKey, Table
+from sqlalchemy import Column, BigInteger, Integer, Interval, Text, DateTime, orm, ForeignKey, Table, Index, \
+    UniqueConstraint
 
 from . import SqlAlchemyBase
-from ..access.permissions import DEFAULT_PERMISSIONS, VerifiablePermissions, Permissions
+from ..access.permissions import DEFAULT_PERMISSIONS, Permissions
 
 user_product_table = Table(
     "user_product",
     SqlAlchemyBase.metadata,
     Column("user_id", ForeignKey("users.id"), primary_key=True),
-    Column("product_id", ForeignKey("products.id"), primary_key=True)
+    Column("product_id", ForeignKey("products.id", ondelete="CASCADE"), primary_key=True),
+    Index("ix_user_product_product_id", "product_id")
 )
 
 
@@ -21,11 +23,21 @@ class Signature(SqlAlchemyBase):
     additional_content = Column(Text, default='', nullable=False)
     comment = Column(Text, default="", nullable=False)
     activation_date = Column(DateTime, default=None)
+    # Maintained by triggers of installations table
+    installations_count = Column(BigInteger, default=0, server_default="0", nullable=False)
 
-    product_id = Column(BigInteger, ForeignKey("products.id"), nullable=False)
+    product_id = Column(BigInteger, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
     product = orm.relationship("Product")
 
-    installations = orm.relationship("Installation", back_populates="signature")
+    installations = orm.relationship("Installation", back_populates="signature", passive_deletes=True)
+
+    __table_args__ = (
+        # Searching keys by prefix (`LIKE 'prefix%'` can't use the unique index unless collation is "C")
+        Index("ix_signatures_license_key_pattern", "license_key", postgresql_ops={"license_key": "text_pattern_ops"}),
+        # Searching comments by substring
+        Index("ix_signatures_comment_trgm", "comment", postgresql_using="gin",
+              postgresql_ops={"comment": "gin_trgm_ops"}),
+    )
 
 
 class Product(SqlAlchemyBase):
@@ -38,11 +50,17 @@ class Product(SqlAlchemyBase):
     sig_sessions_limit = Column(Integer, default=None)  # Limit sessions per signature
     sig_period = Column(Interval, default=None)  # License period per signature
     additional_content = Column(Text, default='', nullable=False)
+    # Maintained by triggers of signatures table
+    signatures_count = Column(BigInteger, default=0, server_default="0", nullable=False)
 
-    signatures = orm.relationship("Signature", back_populates="product")
+    signatures = orm.relationship("Signature", back_populates="product", passive_deletes=True)
 
     owners = orm.relationship('User', secondary=user_product_table, back_populates="owned_products")
 
+    __table_args__ = (
+        UniqueConstraint("name", name="uq_products_name"),
+    )
+
 
 class Installation(SqlAlchemyBase):
     """Installation Model for SQLAlchemy"""
@@ -51,9 +69,23 @@ class Installation(SqlAlchemyBase):
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     fingerprint = Column(Text, nullable=False)
 
-    signature_id = Column(BigInteger, ForeignKey("signatures.id"), nullable=False)
+    signature_id = Column(BigInteger, ForeignKey("signatures.id", ondelete="CASCADE"), nullable=False)
     signature = orm.relationship("Signature")
 
+    __table_args__ = (
+        # Counting installations of signature and searching them by fingerprint
+        UniqueConstraint("signature_id", "fingerprint", name="uq_installations_signature_id_fingerprint"),
+        # Searching installations by fingerprint only
+        Index("ix_installations_fingerprint", "fingerprint"),
+    )
+
+
+class Heartbeat(SqlAlchemyBase):
+    """Single row regularly updated on primary, so replicas can tell how far behind they are"""
+    __tablename__ = "heartbeat"
+    id = Column(Integer, primary_key=True)
+    beat_at = Column(DateTime, nullable=False)
+
 
 class User(SqlAlchemyBase):
     """User Model for SQLAlchemy"""
@@ -65,17 +97,15 @@ class User(SqlAlchemyBase):
 
     owned_products = orm.relationship('Product', secondary=user_product_table, back_populates="owners")
 
-    master_id = Column(BigInteger, ForeignKey('users.id'))
+    master_id = Column(BigInteger, ForeignKey('users.id'), index=True)
     master = orm.relationship('User', backref='slaves', remote_side='User.id', lazy='joined')
 
+    __table_args__ = (
+        UniqueConstraint("username", name="uq_users_username"),
+    )
+
     def get_permissions(self) -> Permissions:
         """
         :return: Permissions object interpretation
         """
         return Permissions(self.permissions)
-
-    def get_verifiable_permissions(self) -> VerifiablePermissions:
-        """
-        :return: VerifiablePermissions object interpretation
-        """
-        return VerifiablePermissions(self)
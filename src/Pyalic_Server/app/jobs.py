@@ -0,0 +1,124 @@
+"""
+Background jobs of admin API. Their progress is kept in redis, so every worker is able to report it
+"""
+import asyncio
+import secrets
+from contextlib import asynccontextmanager, suppress
+
+from redis.exceptions import RedisError
+
+from .licensing import redis
+from .loggers import logger
+
+JOB_TTL = 24 * 60 * 60  # Seconds to keep status of job after its last update
+# Seconds the running job keeps its target locked since the lease was prolonged last time (it's prolonged every
+# third of this period while the job runs), so the target is released soon if the worker running the job dies
+JOB_LEASE = 60
+
+# Prolong lease of target only if it's still held by the job
+_prolong_lease = redis.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+def _job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def _target_key(kind: str, target: int) -> str:
+    return f"running_job:{kind}:{target}"
+
+
+async def create_job(kind: str, target: int, total: int, owner: int) -> tuple[str, bool]:
+    """
+    Register a new job unless the same one is already running
+    :param kind: Kind of job (e.g. "delete_product")
+    :param target: ID of object processed by job
+    :param total: Quantity of items to be processed
+    :param owner: ID of user who started the job
+    :return: Job ID and whether it's a new job (if not, ID of running one is returned)
+    """
+    job_id = secrets.token_urlsafe(16)
+    while not await redis.set(_target_key(kind, target), job_id, nx=True, ex=JOB_LEASE):
+        running_id = await redis.get(_target_key(kind, target))
+        if running_id is not None:
+            return running_id.decode(), False
+        # Running job has just finished or lost its lease, so try to take it again
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={"kind": kind, "target": target, "owner": owner, "status": "running",
+                                             "total": total, "done": 0})
+        pipe.expire(_job_key(job_id), JOB_TTL)
+        await pipe.execute()
+    return job_id, True
+
+
+async def report_progress(job_id: str, done: int):
+    """
+    :param job_id: ID of job
+    :param done: Quantity of items processed so far
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), "done", done)
+        pipe.expire(_job_key(job_id), JOB_TTL)
+        await pipe.execute()
+
+
+async def _prolong_lease_forever(job_id: str):
+    kind, target = await redis.hmget(_job_key(job_id), "kind", "target")
+    while True:
+        try:
+            await _prolong_lease(keys=[_target_key(kind.decode(), int(target))], args=[job_id, JOB_LEASE])
+        except RedisError as exc:
+            await logger.error(f"Failed to prolong lease of job {job_id}: {exc}")
+        await asyncio.sleep(JOB_LEASE / 3)
+
+
+@asynccontextmanager
+async def holding_lease(job_id: str):
+    """
+    Keep target of job locked while the job is running in this worker, however long its steps take
+    :param job_id: ID of job
+    """
+    task = asyncio.create_task(_prolong_lease_forever(job_id))
+    try:
+        yield
+    finally:
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+
+async def finish_job(job_id: str, error: str | None = None):
+    """
+    Mark job as done (or failed if error is specified), so the same job is able to be started again
+    :param job_id: ID of job
+    :param error: Explanation why job failed
+    """
+    kind, target = await redis.hmget(_job_key(job_id), "kind", "target")
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={"status": "done"} if error is None else
+                  {"status": "failed", "error": error})
+        pipe.expire(_job_key(job_id), JOB_TTL)
+        if kind is not None:
+            pipe.delete(_target_key(kind.decode(), int(target)))
+        await pipe.execute()
+
+
+async def get_job(job_id: str) -> dict[str, str] | None:
+    """
+    :param job_id: ID of job
+    :return: Fields of job or `None` if it doesn't exist (or expired)
+    """
+    data = await redis.hgetall(_job_key(job_id))
+    if not data:
+        return None
+    job = {"id": job_id, **{k.decode(): v.decode() for k, v in data.items()}}
+    if job["status"] == "running":
+        running_id = await redis.get(_target_key(job["kind"], int(job["target"])))
+        if running_id is None or running_id.decode() != job_id:
+            # Lease expired without progress, so the worker running the job has died
+            job.update(status="failed", error="Job was interrupted")
+    return job
@@ -2,7 +2,26 @@
 Licensing and sessions mechanics placed here
 """
 from redis.asyncio import Redis
+from redis.exceptions import NoScriptError
 
 from .. import config
 
 redis = Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=config.REDIS_DB, password=config.REDIS_PASSWORD)
+
+
+async def run_script(script, calls: list[tuple[list, list]]) -> list:
+    """
+    Run Lua script many times in one round trip
+    :param script: Registered script
+    :param calls: Keys and args of every call
+    :return: Results of calls
+    """
+    while True:
+        async with redis.pipeline(transaction=False) as pipe:
+            for keys, args in calls:
+                pipe.evalsha(script.sha, len(keys), *keys, *args)
+            try:
+                return await pipe.execute()
+            except NoScriptError:
+                # Script cache of redis was flushed, load it again
+                await redis.script_load(script.script)
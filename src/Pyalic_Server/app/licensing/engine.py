@@ -1,15 +1,20 @@
 """
 Wrapper to easily use licensing engine
 """
+import sys
+from contextlib import suppress
 from dataclasses import dataclass
 from datetime import datetime, timedelta
+from sqlalchemy import Integer, Text, column, exists, func, literal, or_, update, values
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ..db import models
-from . import status
-from .sessions import search_sessions, create_session
+from .. import config
+from ..cache import TTLCache, on_invalidation, invalidate
+from . import status, write_behind
+from .sessions import create_sessions, end_session, SessionNotFoundException
 
 
 @dataclass
@@ -17,48 +22,338 @@ class CheckLicenseResponse:  # pylint: disable=missing-class-docstring
     success: bool
     error: str = None
     session_id: str = None
+    additional_content_signature: str = None
+    additional_content_product: str = None
 
 
-async def process_check_request(license_key: str, fingerprint: str, session: AsyncSession) -> CheckLicenseResponse:
+@dataclass(frozen=True)
+class LicenseMeta:  # pylint: disable=too-many-instance-attributes
+    """Rarely changing data of signature and its product needed to process check request"""
+    signature_id: int
+    product_id: int
+    activation_date: datetime | None
+    sig_install_limit: int | None
+    sig_sessions_limit: int | None
+    sig_period: timedelta | None
+    additional_content_signature: str
+    additional_content_product: str
+
+    def size(self) -> int:
+        """Approximate size of object in memory"""
+        return sys.getsizeof(self) + 256 + \
+            sys.getsizeof(self.additional_content_signature) + sys.getsizeof(self.additional_content_product)
+
+
+# License key -> LicenseMeta
+license_cache = TTLCache(config.LICENSE_CACHE_SIZE, config.LICENSE_CACHE_MAX_BYTES, config.LICENSE_CACHE_TTL)
+# (Signature ID, fingerprint) -> True for known installations (they're removed only with signature)
+installations_cache = TTLCache(config.LICENSE_CACHE_SIZE, config.LICENSE_CACHE_MAX_BYTES, config.LICENSE_CACHE_TTL)
+
+
+def _invalidate_signature(signature_id: str | None):
+    if signature_id is None:
+        license_cache.clear()
+        installations_cache.clear()
+        return
+    license_cache.pop_where(lambda _, meta: meta.signature_id == int(signature_id))
+    installations_cache.pop_where(lambda key, _: key[0] == int(signature_id))
+
+
+def _invalidate_product(product_id: str | None):
+    if product_id is None:
+        license_cache.clear()
+        return
+    license_cache.pop_where(lambda _, meta: meta.product_id == int(product_id))
+
+
+on_invalidation("signature", _invalidate_signature)
+on_invalidation("product", _invalidate_product)
+
+
+async def invalidate_signature(signature_id: int):
+    """Drop cached data of signature in all workers (must be called when signature is changed or deleted)"""
+    await invalidate("signature", signature_id)
+
+
+async def invalidate_product(product_id: int):
+    """Drop cached data of product in all workers (must be called when product is changed or deleted)"""
+    await invalidate("product", product_id)
+
+
+def cache_stats() -> dict[str, dict[str, int]]:
+    """
+    :return: Counters of licensing caches
+    """
+    return {"license_cache": license_cache.stats(), "installations_cache": installations_cache.stats()}
+
+
+def _check_query(requests: list[tuple[int, str, str]]):
+    """
+    Query getting everything needed to process check requests at once
+    :param requests: Index, license key and fingerprint of every request
+    """
+    req = values(column("idx", Integer), column("license_key", Text), column("fingerprint", Text),
+                 name="check_requests").data(requests)
+    return select(
+        req.c.idx,
+        models.Signature.id,
+        models.Signature.product_id,
+        models.Signature.activation_date,
+        models.Signature.additional_content.label("additional_content_signature"),
+        models.Product.sig_install_limit,
+        models.Product.sig_sessions_limit,
+        models.Product.sig_period,
+        models.Product.additional_content.label("additional_content_product"),
+        models.Signature.installations_count.label("installed"),
+        exists().where(models.Installation.signature_id == models.Signature.id,
+                       models.Installation.fingerprint == req.c.fingerprint).label("is_installed"),
+    ).select_from(req).join(models.Signature, models.Signature.license_key == req.c.license_key).join(
+        models.Product, models.Signature.product_id == models.Product.id)
+
+
+async def _get_licenses(requests: list[tuple[str, str]], session: AsyncSession,
+                        cache: bool = True) -> dict[int, tuple[LicenseMeta, int | None, bool]]:
+    """
+    Get data of signatures using cache where possible
+    :param requests: License key and fingerprint of every request
+    :param cache: Whether signatures read from database are cached (data of lagging replica mustn't be, as
+    invalidation may be applied before replica replays the change)
+    :return: Index of request -> signature data, quantity of installations (`None` if it's not needed or
+    unknown) and whether the fingerprint is already installed. Requests with non-existent signatures are skipped
+    """
+    res = {}
+    uncached = []
+    for idx, (license_key, fingerprint) in enumerate(requests):
+        meta = license_cache.get(license_key)
+        if meta is not None and installations_cache.get((meta.signature_id, fingerprint)):
+            res[idx] = (meta, None, True)
+        else:
+            uncached.append((idx, license_key, fingerprint))
+    if not uncached:
+        return res
+    # Signature may be changed while it's read, so it's cached only if nothing was invalidated meanwhile
+    generation = license_cache.generation
+    r = await session.execute(_check_query(uncached))
+    for row in r:
+        meta = LicenseMeta(signature_id=row.id, product_id=row.product_id, activation_date=row.activation_date,
+                           sig_install_limit=row.sig_install_limit, sig_sessions_limit=row.sig_sessions_limit,
+                           sig_period=row.sig_period, additional_content_signature=row.additional_content_signature,
+                           additional_content_product=row.additional_content_product)
+        if cache:
+            license_cache.set(requests[row.idx][0], meta, meta.size(), generation)
+        res[row.idx] = (meta, row.installed, row.is_installed)
+    return res
+
+
+def _check_limits(sig: LicenseMeta, installed: int | None, is_installed: bool, now: datetime) -> str | None:
+    """
+    Check license period and installations limit of signature
+    :return: Error or `None` if access may be granted
+    """
+    # Check license period
+    current_period = now - sig.activation_date if sig.activation_date is not None else timedelta(seconds=0)
+    if sig.sig_period is not None and sig.sig_period < current_period:
+        return status.LICENSE_EXPIRED
+    # Check installation limit
+    if sig.sig_install_limit is not None and not is_installed and installed >= sig.sig_install_limit:
+        return status.INSTALLATIONS_LIMIT
+    return None
+
+
+def _check_requests(requests: list[tuple[str, str]], licenses: dict[int, tuple[LicenseMeta, int | None, bool]],
+                    indices: list[int], granted: dict[int, set[str]], now: datetime) -> dict[int, str | None]:
+    """
+    Check license periods and installations limits for requests of existing signatures
+    (installations made by previous requests are taken into account)
+    :param indices: Indices of requests to be checked in ascending order
+    :param granted: Signature ID -> fingerprints newly installed by requests which were already granted
+    :return: Index of request -> error or `None` if access may be granted
+    """
+    res = {}
+    # Signature ID -> fingerprints installed by previous requests
+    new_installations = {signature_id: set(added) for signature_id, added in granted.items()}
+    for idx in indices:
+        sig, installed, is_installed = licenses[idx]
+        added = new_installations.setdefault(sig.signature_id, set())
+        res[idx] = _check_limits(sig, None if installed is None else installed + len(added),
+                                 is_installed or requests[idx][1] in added, now)
+        if res[idx] is None and not is_installed:
+            added.add(requests[idx][1])
+    return res
+
+
+def _signature_ends(sig: LicenseMeta, now: datetime) -> int | None:
+    """
+    :return: Timestamp when signature expires (`None` if it doesn't)
+    """
+    if sig.sig_period is None:
+        return None
+    return int((sig.sig_period + (sig.activation_date or now)).timestamp())
+
+
+def _register_query(signature_id: int, fingerprint: str, now: datetime):
+    """
+    Statement activating signature (if it isn't yet) and registering installation if product limit allows it.
+    Updating the signature locks its row, so concurrent registrations for the same signature run one by one, and
+    every next one sees `installations_count` (maintained by trigger) already incremented by the previous ones
+    :return: Whether signature exists and whether the fingerprint is installed (now or before)
+    """
+    sig = update(models.Signature).where(models.Signature.id == signature_id).values(
+        activation_date=func.coalesce(models.Signature.activation_date, now)
+    ).returning(models.Signature.id, models.Signature.product_id, models.Signature.installations_count).cte("sig")
+    new = select(sig.c.id, literal(fingerprint, Text)).join(models.Product, models.Product.id == sig.c.product_id).where(
+        or_(models.Product.sig_install_limit.is_(None), sig.c.installations_count < models.Product.sig_install_limit))
+    ins = insert(models.Installation).from_select(["signature_id", "fingerprint"], new).on_conflict_do_nothing(
+        index_elements=["signature_id", "fingerprint"]).returning(models.Installation.id).cte("ins")
+    installed_before = exists().where(models.Installation.signature_id == signature_id,
+                                      models.Installation.fingerprint == fingerprint)
+    return select(select(sig.c.id).exists().label("signature_exists"),
+                  or_(select(ins.c.id).exists(), installed_before).label("installed"))
+
+
+async def _register_installations(register: list[tuple[int, int, str, int | None, bool]], now: datetime,
+                                  session: AsyncSession) -> dict[int, str | None]:
+    """
+    Activate signatures and register new installations, so installations limits are never exceeded
+    :param register: Index of request, signature ID, fingerprint, installations limit and whether
+    signature needs activation for every installation (limits are read from database here)
+    :param now: Activation date
+    :param session: AsyncSession of database
+    :return: Index of request -> error or `None` if installation is registered
+    """
+    res = {}
+    # Lock signatures in the same order by every request to avoid deadlocks
+    for idx, signature_id, fingerprint, *_ in sorted(register, key=lambda item: (item[1], item[0])):
+        row = (await session.execute(_register_query(signature_id, fingerprint, now))).one()
+        if not row.signature_exists:  # Deleted since it was read
+            res[idx] = status.INVALID_KEY
+        elif row.installed:
+            res[idx] = None
+        else:
+            # The statement saw snapshot taken before it waited for the lock of signature, so installation of the
+            # same fingerprint committed by concurrent request meanwhile is only visible to a new statement
+            installed = await session.execute(select(exists().where(
+                models.Installation.signature_id == signature_id, models.Installation.fingerprint == fingerprint)))
+            res[idx] = None if installed.scalar() else status.INSTALLATIONS_LIMIT
+    if register:
+        await session.commit()
+    return res
+
+
+async def _apply_registrations(errors: dict[int, str | None], requests: list[tuple[str, str]],
+                               licenses: dict[int, tuple[LicenseMeta, int | None, bool]],
+                               responses: list[CheckLicenseResponse], generation: int):
+    """
+    Deny requests which failed to register installation and update caches for the granted ones
+    :param errors: Index of request -> error of registration or `None` (see `_register_installations`)
+    :param generation: `generation` of installations cache taken before signatures were read
+    """
+    for idx, error in errors.items():
+        if error is not None:
+            # Limit was reached by concurrent request after signature was read, so release the session
+            with suppress(SessionNotFoundException):
+                await end_session(responses[idx].session_id)
+            responses[idx] = CheckLicenseResponse(success=False, error=error)
+    # Installations of signatures invalidated since they were read aren't cached
+    for idx, response in enumerate(responses):
+        if response.success:
+            fingerprint = requests[idx][1]
+            installations_cache.set((licenses[idx][0].signature_id, fingerprint), True,
+                                    sys.getsizeof(fingerprint) + 128, generation)
+    for signature_id in {licenses[idx][0].signature_id for idx in errors if licenses[idx][0].activation_date is None}:
+        await invalidate_signature(signature_id)
+
+
+async def _start_sessions(licenses: dict[int, tuple[LicenseMeta, int | None, bool]], indices: list[int],
+                          now: datetime) -> dict[int, str | None]:
+    """
+    Start new sessions for requests if sessions limits of their signatures allow it
+    :return: Index of request -> session ID or `None` if sessions limit is reached
+    """
+    session_ids = await create_sessions([(licenses[idx][0].signature_id, _signature_ends(licenses[idx][0], now),
+                                          licenses[idx][0].sig_sessions_limit) for idx in indices])
+    return dict(zip(indices, session_ids))
+
+
+async def _admit_requests(requests: list[tuple[str, str]], licenses: dict[int, tuple[LicenseMeta, int | None, bool]],
+                          now: datetime) -> list[CheckLicenseResponse]:
+    """
+    Check limits of requests and start sessions for the ones which passed them, as if they were checked one by one
+    :return: Response to every request
+    """
+    responses = [CheckLicenseResponse(success=False, error=status.INVALID_KEY)] * len(requests)
+    granted: dict[int, set[str]] = {}  # Signature ID -> fingerprints newly installed by granted requests
+    pending = sorted(licenses)
+    while pending:
+        checked = _check_requests(requests, licenses, pending, granted, now)
+        # If all Ok, start new sessions for these signatures if sessions limits allow it
+        sessions = await _start_sessions(licenses, [idx for idx in pending if checked[idx] is None], now)
+        denied = set()  # Signatures which requests were denied because of sessions limit
+        for idx, session_id in sessions.items():
+            sig, _, is_installed = licenses[idx]
+            if session_id is None:
+                checked[idx] = status.SESSIONS_LIMIT
+                denied.add(sig.signature_id)
+                continue
+            responses[idx] = CheckLicenseResponse(success=True, session_id=session_id,
+                                                  additional_content_signature=sig.additional_content_signature,
+                                                  additional_content_product=sig.additional_content_product)
+            if not is_installed:
+                granted.setdefault(sig.signature_id, set()).add(requests[idx][1])
+        # Installations of requests denied because of sessions limit mustn't count, so requests which exceeded
+        # installations limit because of them are checked again
+        pending = [idx for idx in pending
+                   if checked[idx] == status.INSTALLATIONS_LIMIT and licenses[idx][0].signature_id in denied]
+        for idx, error in checked.items():
+            if error is not None and idx not in pending:
+                responses[idx] = CheckLicenseResponse(success=False, error=error)
+    return responses
+
+
+async def process_check_requests(requests: list[tuple[str, str]], session: AsyncSession,
+                                 read_session: AsyncSession = None) -> list[CheckLicenseResponse]:
+    """
+    Process many check requests at once (with the same semantics as `process_check_request`)
+    :param requests: Client's license key and fingerprint of every request
+    :param session: AsyncSession of database
+    :param read_session: AsyncSession to read signatures with (i.e. of replica), `session` is used by default.
+    Signatures read with another session than `session` aren't cached
+    :return: Response to every request
+    """
+    generation = installations_cache.generation
+    read_session = read_session or session
+    licenses = await _get_licenses(requests, read_session, cache=read_session is session)
+    now = datetime.utcnow()
+    responses = await _admit_requests(requests, licenses, now)
+    # Activate Signatures and register installations if needed
+    register = [(idx, licenses[idx][0].signature_id, requests[idx][1], licenses[idx][0].sig_install_limit,
+                 licenses[idx][0].activation_date is None)
+                for idx, response in enumerate(responses)
+                if response.success and (licenses[idx][0].activation_date is None or not licenses[idx][2])]
+    try:
+        if config.WRITE_BEHIND:
+            errors = await write_behind.reserve_installations(register, now, session)
+        else:
+            errors = await _register_installations(register, now, session)
+    except BaseException:
+        # Sessions are already admitted, so they mustn't take places of signatures if installations aren't saved
+        for response in responses:
+            if response.success:
+                with suppress(SessionNotFoundException):
+                    await end_session(response.session_id)
+        raise
+    await _apply_registrations(errors, requests, licenses, responses, generation)
+    return responses
+
+
+async def process_check_request(license_key: str, fingerprint: str, session: AsyncSession,
+                                read_session: AsyncSession = None) -> CheckLicenseResponse:
     """
 
     :param license_key: Client's license key
     :param fingerprint: Client's fingerprint
     :param session: AsyncSession of database
+    :param read_session: AsyncSession to read signatures with (i.e. of replica), `session` is used by default
     :return: `False` and explanation why access mustn't be granted or 'True` and session ID
     """
-    # Get signature
-    r = await session.execute(select(models.Signature).filter_by(license_key=license_key).options(
-        selectinload(models.Signature.product), selectinload(models.Signature.installations)))
-    sig = r.scalar_one_or_none()
-    if sig is None:
-        return CheckLicenseResponse(success=False, error=status.INVALID_KEY)
-    # Check license period
-    current_period = datetime.utcnow() - sig.activation_date if sig.activation_date is not None else timedelta(
-        seconds=0)
-    if sig.product.sig_period is not None and sig.product.sig_period < current_period:
-        return CheckLicenseResponse(success=False, error=status.LICENSE_EXPIRED)
-    # Check installation limit
-    current_inst = None
-    if sig.product.sig_install_limit is not None:
-        r = await session.execute(select(models.Installation).filter_by(signature_id=sig.id, fingerprint=fingerprint))
-        current_inst = r.scalar_one_or_none()
-        if current_inst is None and len(sig.installations) >= sig.product.sig_install_limit:
-            return CheckLicenseResponse(success=False, error=status.INSTALLATIONS_LIMIT)
-    # Check sessions limit
-    if sig.product.sig_sessions_limit is not None and \
-            len(await search_sessions(sig.id)) >= sig.product.sig_sessions_limit:
-        return CheckLicenseResponse(False, error=status.SESSIONS_LIMIT)
-    # If all Ok, activate Signature if needed
-    if sig.activation_date is None:
-        sig.activation_date = datetime.utcnow()
-    # And register installation if it's a new one
-    if current_inst is None:
-        current_inst = models.Installation(signature_id=sig.id, fingerprint=fingerprint)
-        session.add(current_inst)
-        await session.commit()
-    # Start a new session for this signature
-    sig_ends = int((sig.product.sig_period + sig.activation_date).timestamp()) \
-        if sig.product.sig_period is not None else None
-    session_id = await create_session(sig.id, signature_ends=sig_ends)
-    return CheckLicenseResponse(success=True, session_id=session_id)
+    return (await process_check_requests([(license_key, fingerprint)], session, read_session))[0]
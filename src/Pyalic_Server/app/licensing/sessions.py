@@ -1,11 +1,13 @@
 """
 Sessions mechanics
 """
-import random
-from string import ascii_letters, digits
+import hmac
+import secrets
+from base64 import urlsafe_b64encode
+from hashlib import sha256
 from datetime import datetime
 
-from . import redis
+from . import redis, run_script
 from .. import config
 from ..loggers import logger
 
@@ -16,49 +18,184 @@ class SessionNotFoundException(Exception):
     """
 
 
+class SessionsLimitException(Exception):
+    """
+    Signature already has maximum allowed quantity of active sessions
+    """
+
+
+# Atomically trim expired sessions of signature, check their quantity and start a new one
+# KEYS: Session ID, index of signature sessions
+# ARGV: current timestamp, session TTL in milliseconds, expiration timestamp, sessions limit (-1 if unlimited),
+#       TTL of index in seconds
+# Returns 1 if session started, 0 if sessions limit reached, -1 if Session ID is already taken
+_admit_session = redis.register_script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+local limit = tonumber(ARGV[4])
+if limit >= 0 and redis.call('ZCARD', KEYS[2]) >= limit then
+    return 0
+end
+if not redis.call('SET', KEYS[1], 1, 'NX', 'PX', ARGV[2]) then
+    return -1
+end
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 1
+""")
+
+# Prolong existing session and its entry in index of signature sessions
+# KEYS: Session ID, index of signature sessions
+# ARGV: session TTL in milliseconds, expiration timestamp, TTL of index in seconds
+# Returns 1 if session prolonged, 0 if session doesn't exist
+_refresh_session = redis.register_script("""
+if redis.call('PEXPIRE', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[2], ARGV[2], KEYS[1])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+""")
+
+
+if not config.SECRET_KEY:
+    # Session IDs signed with empty key could be forged by anyone
+    raise RuntimeError("SECRET_KEY must be set to sign Session IDs")
+# Keyed hash prepared once, copied for every session ID
+_session_mac = hmac.new(config.SECRET_KEY.encode(), digestmod=sha256)
+
+
+def _sign(payload: str) -> str:
+    """
+    :return: MAC of payload (part of Session ID)
+    """
+    mac = _session_mac.copy()
+    mac.update(payload.encode())
+    return urlsafe_b64encode(mac.digest()[:16]).rstrip(b"=").decode()
+
+
 def _random_session_id(signature_id: int, signature_ends: int) -> str:
-    return f"{str(signature_id)}:{signature_ends}:" + "".join(
-        [random.choice(ascii_letters + digits) for _ in range(32)])
+    payload = f"{signature_id}:{signature_ends}:{secrets.token_urlsafe(12)}"
+    return f"{payload}:{_sign(payload)}"
+
+
+def _index_key(signature_id: int | str) -> str:
+    """Key of sorted set indexing sessions of signature (scored by expiration timestamp)"""
+    return f"sig_sessions:{signature_id}"
+
+
+def _parse_session_id(session_id: str) -> tuple[str, int | None]:
+    """
+    Verify Session ID and get signature ID and signature expiration timestamp from it
+    :return: Signature ID and timestamp or `None` if signature doesn't expire
+    :raises SessionNotFoundException: If Session ID is malformed or forged (so it can't exist)
+    """
+    payload, _, mac = session_id.rpartition(":")
+    try:
+        # Bytes are compared, because `compare_digest` doesn't support non-ASCII strings
+        valid = hmac.compare_digest(_sign(payload).encode(), mac.encode())
+        signature_id, signature_ends, _ = payload.split(":")
+        signature_ends = int(signature_ends)
+    except ValueError as exc:  # Including UnicodeEncodeError of unpaired surrogates
+        raise SessionNotFoundException from exc
+    if not valid:
+        raise SessionNotFoundException
+    return signature_id, signature_ends or None
+
+
+def _session_ttl(signature_ends: int | None, now: float) -> int:
+    """
+    Get period while session is alive without keep-alive signals
+    :param signature_ends: Timestamp when session must be ended because of signature expiration
+    :param now: Current timestamp
+    :return: TTL in milliseconds
+    """
+    if signature_ends is None or signature_ends - config.SESSION_ALIVE_PERIOD > now:
+        # Signature doesn't expire end before session should expire
+        return config.SESSION_ALIVE_PERIOD * 1000
+    # Signature must be expired with session
+    return max(int((signature_ends - now) * 1000), 1)
 
 
-async def create_session(signature_id: int, signature_ends: int | None) -> str:
+async def create_sessions(requests: list[tuple[int, int | None, int | None]]) -> list[str | None]:
+    """
+    Create many licensing sessions in one round trip
+    :param requests: ID of Signature, timestamp when session must be ended because of signature expiration and
+    maximum quantity of active sessions of signature (`None` if unlimited) for every session
+    :return: Session IDs (`None` where signature already has maximum allowed quantity of active sessions)
+    """
+    session_ids = [None] * len(requests)
+    pending = list(range(len(requests)))
+    while pending:
+        candidates = {}
+        calls = []
+        for i in pending:
+            signature_id, signature_ends, sessions_limit = requests[i]
+            candidates[i] = _random_session_id(signature_id, signature_ends or 0)
+            now = datetime.now().timestamp()
+            ttl = _session_ttl(signature_ends, now)
+            calls.append(([candidates[i], _index_key(signature_id)],
+                          [now, ttl, now + ttl / 1000, -1 if sessions_limit is None else sessions_limit,
+                           config.SESSION_ALIVE_PERIOD]))
+        # Check limits and add sessions to redis in one step
+        results = await run_script(_admit_session, calls)
+        retry = []
+        for i, admitted in zip(pending, results):
+            if admitted == 1:
+                session_ids[i] = candidates[i]
+                await logger.info(f"Created new session {candidates[i]}")
+            elif admitted == -1:
+                # If current ID already exists, create different one
+                retry.append(i)
+        pending = retry
+    return session_ids
+
+
+async def create_session(signature_id: int, signature_ends: int | None, sessions_limit: int | None = None) -> str:
     """
     Create licensing session
     :param signature_id: ID of Signature
     :param signature_ends: Timestamp when session must be ended because of signature expiration
+    :param sessions_limit: Maximum quantity of active sessions of signature (`None` if unlimited)
     :return: Session ID
+    :raises SessionsLimitException: If signature already has `sessions_limit` active sessions
     """
-    session_id = _random_session_id(signature_id, signature_ends or 0)
-    while await redis.exists(session_id):
-        # While current ID already exists, create different one
-        session_id = _random_session_id(signature_id, signature_ends or 0)
-    # Add session to redis
-    if signature_ends is None or signature_ends - config.SESSION_ALIVE_PERIOD > datetime.now().timestamp():
-        # Signature doesn't expire end before session should expire
-        await redis.set(session_id, 1, ex=config.SESSION_ALIVE_PERIOD)
-    else:
-        # Signature must be expired with session
-        await redis.set(session_id, 1, exat=signature_ends)
-    await logger.info(f"Created new session {session_id}")
+    session_id = (await create_sessions([(signature_id, signature_ends, sessions_limit)]))[0]
+    if session_id is None:
+        raise SessionsLimitException
     return session_id
 
 
+async def keep_alive_many(session_ids: list[str]) -> list[bool]:
+    """
+    Keep-alive many sessions in one round trip
+    :param session_ids: Session IDs
+    :return: Whether every session exists (i.e. was kept alive)
+    """
+    res = [False] * len(session_ids)
+    calls = []
+    existing = []
+    for i, session_id in enumerate(session_ids):
+        try:
+            signature_id, signature_ends = _parse_session_id(session_id)
+        except SessionNotFoundException:
+            continue
+        now = datetime.now().timestamp()
+        ttl = _session_ttl(signature_ends, now)
+        calls.append(([session_id, _index_key(signature_id)], [ttl, now + ttl / 1000, config.SESSION_ALIVE_PERIOD]))
+        existing.append(i)
+    if calls:
+        for i, refreshed in zip(existing, await run_script(_refresh_session, calls)):
+            res[i] = refreshed == 1
+    return res
+
+
 async def keep_alive(session_id: str):
     """
     Keep-alive session
     :param session_id: Session ID
     """
-    if not await redis.exists(session_id):
+    if not (await keep_alive_many([session_id]))[0]:
         raise SessionNotFoundException
-    signature_ends = int(session_id.split(":")[1])
-    if signature_ends == 0:
-        signature_ends = None
-    if signature_ends is None or signature_ends - config.SESSION_ALIVE_PERIOD > datetime.now().timestamp():
-        # Signature doesn't expire end before session should expire
-        await redis.set(session_id, 1, ex=config.SESSION_ALIVE_PERIOD)
-    else:
-        # Signature must be expired with session
-        await redis.set(session_id, 1, exat=signature_ends)
 
 
 async def end_session(session_id: str):
@@ -66,19 +203,12 @@ async def end_session(session_id: str):
     Correctly end session
     :param session_id: Session ID
     """
-    if not await redis.exists(session_id):
+    signature_id, _ = _parse_session_id(session_id)
+    # Just delete session from redis
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(session_id)
+        pipe.zrem(_index_key(signature_id), session_id)
+        deleted, _ = await pipe.execute()
+    if not deleted:
         raise SessionNotFoundException
-    await redis.delete(session_id)  # Just delete session from redis
     await logger.info(f"Ended session {session_id}")
-
-
-async def search_sessions(signature_id: int) -> list[str]:
-    """
-    Get active session IDs of specified signature
-    :param signature_id: Signature ID
-    :return:
-    """
-    res = []
-    async for session_id in redis.scan_iter(match=f"{signature_id}:*:*"):
-        res.append(session_id)
-    return res
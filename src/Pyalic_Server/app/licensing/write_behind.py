@@ -0,0 +1,217 @@
+"""
+Write-behind of activations and installations: check requests are admitted after reservation in redis,
+and reserved installations are flushed to database in batches by background task of every worker
+"""
+import asyncio
+import os
+import socket
+from datetime import datetime
+from sqlalchemy import BigInteger, DateTime, Text, column, select, update, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from redis.exceptions import RedisError, ResponseError
+
+from . import redis, run_script, status
+from .. import config
+from ..cache import invalidate
+from ..db import models, create_session
+from ..loggers import logger
+
+STREAM = "write_behind"  # Durable queue of reserved installations
+GROUP = "flushers"
+
+# KEYS: fingerprints of signature, marker of loaded fingerprints, stream
+# ARGV: fingerprint, installations limit (-1 if unlimited), TTL of reservations, signature ID, activation date,
+# whether signature needs activation
+# Returns 1 if installation is reserved, 0 if limit is reached, -1 if fingerprints must be loaded firstly
+_reserve_installation = redis.register_script("""
+local limit = tonumber(ARGV[2])
+if limit >= 0 then
+    if redis.call('EXISTS', KEYS[2]) == 0 then
+        return -1
+    end
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 1 and ARGV[6] == '0' then
+        return 1
+    end
+    if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+        if redis.call('SCARD', KEYS[1]) >= limit then
+            return 0
+        end
+        redis.call('SADD', KEYS[1], ARGV[1])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+redis.call('XADD', KEYS[3], '*', 'signature_id', ARGV[4], 'fingerprint', ARGV[1], 'at', ARGV[5])
+return 1
+""")
+
+# KEYS: fingerprints of signature, marker of loaded fingerprints
+# ARGV: TTL of reservations, fingerprints installed according to database
+# Fingerprints are loaded only once, later reservations must not be overwritten by stale database state
+_load_installations = redis.register_script("""
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+if #ARGV > 1 then
+    redis.call('SADD', KEYS[1], unpack(ARGV, 2))
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+redis.call('SET', KEYS[2], 1, 'EX', ARGV[1])
+return 1
+""")
+
+
+def _installations_key(signature_id: int) -> str:
+    return f"installations:{signature_id}"
+
+
+def _loaded_key(signature_id: int) -> str:
+    return f"installations_loaded:{signature_id}"
+
+
+async def _load_installations_of(signature_ids: set[int], session: AsyncSession):
+    """Load fingerprints installed on signatures from database to redis (they are limited, so there are a few)"""
+    r = await session.execute(select(models.Installation.signature_id, models.Installation.fingerprint).where(
+        models.Installation.signature_id.in_(signature_ids)))
+    fingerprints = {signature_id: [] for signature_id in signature_ids}
+    for signature_id, fingerprint in r:
+        fingerprints[signature_id].append(fingerprint)
+    await run_script(_load_installations, [
+        ([_installations_key(signature_id), _loaded_key(signature_id)],
+         [config.WRITE_BEHIND_RESERVATION_TTL, *fingerprints[signature_id]])
+        for signature_id in signature_ids])
+
+
+async def reserve_installations(register: list[tuple[int, int, str, int | None, bool]], now: datetime,
+                                session: AsyncSession) -> dict[int, str | None]:
+    """
+    Reserve installations (and activations) in redis and queue them to be flushed to database
+    :param register: Index of request, signature ID, fingerprint, installations limit and whether
+    signature needs activation for every installation
+    :param now: Activation date
+    :param session: AsyncSession of database to load existing installations with
+    :return: Index of request -> error or `None` if installation is reserved
+    """
+    res = {}
+    pending = register
+    while pending:
+        calls = [([_installations_key(signature_id), _loaded_key(signature_id), STREAM],
+                  [fingerprint, -1 if limit is None else limit, config.WRITE_BEHIND_RESERVATION_TTL, signature_id,
+                   now.isoformat(), int(activate)])
+                 for _, signature_id, fingerprint, limit, activate in pending]
+        not_loaded = []
+        for item, reserved in zip(pending, await run_script(_reserve_installation, calls)):
+            if reserved < 0:
+                not_loaded.append(item)
+            else:
+                res[item[0]] = None if reserved else status.INSTALLATIONS_LIMIT
+        if not_loaded:
+            await _load_installations_of({signature_id for _, signature_id, *_ in not_loaded}, session)
+        pending = not_loaded
+    return res
+
+
+async def _ensure_group():
+    """Create consumer group of stream (with stream itself) unless it exists"""
+    try:
+        await redis.xgroup_create(STREAM, GROUP, id="0", mkstream=True)
+    except ResponseError as exc:
+        if "BUSYGROUP" not in str(exc):
+            raise
+
+
+async def _flush(entries: list[tuple[bytes, dict[bytes, bytes]]]):
+    """Write activations and installations of stream entries to database in batched statements"""
+    activations: dict[int, datetime] = {}
+    installations = set()
+    for entry_id, fields in entries:
+        if fields is None:  # Deleted from stream, only acknowledge it
+            continue
+        try:
+            signature_id = int(fields[b"signature_id"])
+            at = datetime.fromisoformat(fields[b"at"].decode())
+            fingerprint = fields[b"fingerprint"].decode()
+        except (KeyError, ValueError) as exc:
+            # It would fail every batch it's replayed in, so it's dropped
+            await logger.error(f"Dropped malformed write-behind entry {entry_id}: {exc!r}")
+            continue
+        activations[signature_id] = min(at, activations.get(signature_id, at))
+        installations.add((signature_id, fingerprint))
+    activated_ids = []
+    if installations:
+        activated_ids = await _write(activations, installations)
+    ids = [entry_id for entry_id, _ in entries]
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.xack(STREAM, GROUP, *ids)
+        pipe.xdel(STREAM, *ids)
+        await pipe.execute()
+    for signature_id in activated_ids:
+        await invalidate("signature", signature_id)
+
+
+async def _write(activations: dict[int, datetime], installations: set[tuple[int, str]]) -> list[int]:
+    """
+    Activate signatures and insert installations in one transaction
+    :return: IDs of signatures activated
+    """
+    activated = values(column("id", BigInteger), column("at", DateTime),
+                       name="activations").data(list(activations.items()))
+    new = values(column("signature_id", BigInteger), column("fingerprint", Text),
+                 name="new_installations").data(list(installations))
+    async with create_session() as session:
+        r = await session.execute(update(models.Signature).where(
+            models.Signature.id == activated.c.id, models.Signature.activation_date.is_(None)
+        ).values(activation_date=activated.c.at).returning(models.Signature.id).execution_options(
+            synchronize_session=False))
+        activated_ids = list(r.scalars())
+        # Installations of signatures deleted since reservation are skipped
+        await session.execute(insert(models.Installation).from_select(
+            ["signature_id", "fingerprint"],
+            select(new.c.signature_id, new.c.fingerprint).join(models.Signature,
+                                                               models.Signature.id == new.c.signature_id)
+        ).on_conflict_do_nothing(index_elements=["signature_id", "fingerprint"]))
+        await session.commit()
+    return activated_ids
+
+
+async def flush_once(consumer: str, block: int | None = None) -> int:
+    """
+    Flush a batch of queued installations. Entries taken by consumers which didn't acknowledge them for
+    `WRITE_BEHIND_CLAIM_IDLE` seconds (crashed, or failed to write) are replayed firstly
+    :param consumer: Name of consumer in group
+    :param block: Milliseconds to wait for new entries (don't wait if `None`)
+    :return: Quantity of flushed entries
+    """
+    await _ensure_group()
+    _, entries, *_ = await redis.xautoclaim(STREAM, GROUP, consumer, int(config.WRITE_BEHIND_CLAIM_IDLE * 1000),
+                                            count=config.WRITE_BEHIND_BATCH_SIZE)
+    if not entries:
+        streams = await redis.xreadgroup(GROUP, consumer, {STREAM: ">"}, count=config.WRITE_BEHIND_BATCH_SIZE,
+                                         block=block)
+        entries = streams[0][1] if streams else []
+    if entries:
+        await _flush(entries)
+    return len(entries)
+
+
+async def flush_forever():
+    """Background task of worker flushing queued installations"""
+    consumer = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            await flush_once(consumer, block=int(config.WRITE_BEHIND_FLUSH_INTERVAL * 1000))
+        except (RedisError, SQLAlchemyError, OSError) as exc:
+            # Entries stay pending, so they are replayed when claim timeout passes
+            await logger.error(f"Failed to flush write-behind queue: {exc}")
+            await asyncio.sleep(config.WRITE_BEHIND_FLUSH_INTERVAL)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            # Task mustn't end, otherwise reservations are never written to database
+            await logger.exception(f"Unexpected error while flushing write-behind queue: {exc!r}")
+            await asyncio.sleep(config.WRITE_BEHIND_FLUSH_INTERVAL)
+
+
+async def queue_length() -> int:
+    """Quantity of installations waiting to be flushed"""
+    return await redis.xlen(STREAM)
@@ -1,66 +1,141 @@
 """
 Routers for only admin access
 """
+import binascii
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from datetime import timedelta, datetime
 from copy import copy
-from fastapi import APIRouter, HTTPException, Depends, status, security, Query
+from dataclasses import asdict
+from time import perf_counter
+from typing import Literal
+from fastapi import APIRouter, HTTPException, Depends, status, security, Query, BackgroundTasks, Response, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import ColumnElement, Select, delete, false, func, insert, text
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
 
 from .. import schema, config
-from ..db import session_dep, models
+from .. import db, jobs, bulk
+from ..db import session_dep, read_session_dep, models
 from ..loggers import logger
 from ..access import auth
+from ..licensing import engine as lic_engine
+from ..licensing import write_behind
 
-router = APIRouter(dependencies=[Depends(auth.get_current_user)])  # Requires user logged in
+router = APIRouter(dependencies=[Depends(auth.get_principal)])  # Requires user logged in
 public_router = APIRouter()  # Not requires login (also used to get token)
 
 
-async def _get_user_with_prod(current_user: schema.User, session: AsyncSession) -> models.User:
-    """Gets user from DB using `User` scheme, with its products"""
-    r = await session.execute(
-        select(models.User).filter_by(id=current_user.id).options(selectinload(models.User.owned_products)))
-    user_in_db = r.scalar_one_or_none()
-    assert user_in_db is not None
-    return user_in_db
-
-
-async def _get_user(current_user: schema.User, session: AsyncSession) -> models.User:
-    """Gets user from DB using `User` scheme"""
-    r = await session.execute(
-        select(models.User).filter_by(id=current_user.id))
-    user_in_db = r.scalar_one_or_none()
-    assert user_in_db is not None
-    return user_in_db
+_EXACT_COUNT_LIMIT = 10000  # Tables with more rows (according to statistics) are counted approximately
+
+
+class Pagination:  # pylint: disable=too-few-public-methods
+    """
+    Query parameters of list endpoints. Keyset pagination (`after_id` or `cursor`) is used if specified,
+    otherwise `offset` is used
+    """
+
+    def __init__(self, limit: int = 100, offset: int = 0, after_id: int = None, cursor: str = None):
+        self.limit = limit
+        self.offset = offset
+        self.after_id = after_id
+        if cursor is not None:
+            try:
+                self.after_id = int(urlsafe_b64decode(cursor.encode()))
+            except (ValueError, binascii.Error) as exc:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor") from exc
+
+    def apply(self, query: Select, id_column) -> Select:
+        """Get a page of query results ordered by ID"""
+        query = query.order_by(id_column).limit(self.limit)
+        if self.after_id is not None:
+            return query.where(id_column > self.after_id)
+        return query.offset(self.offset)
+
+    def next_cursor(self, ids: list[int]) -> str | None:
+        """Cursor of the next page (`None` if the current page is the last one)"""
+        if not ids or len(ids) < self.limit:
+            return None
+        return urlsafe_b64encode(str(ids[-1]).encode()).decode()
+
+
+async def _estimate_count(model, session: AsyncSession) -> int:
+    """Gets quantity of rows of table, approximately if there are many of them"""
+    r = await session.execute(text("SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table)"),
+                              {"table": model.__tablename__})
+    estimate = r.scalar_one_or_none()
+    # Statistics may be absent for a table never analyzed
+    if estimate is not None and estimate > _EXACT_COUNT_LIMIT:
+        return int(estimate)
+    r = await session.execute(select(func.count()).select_from(model))  # pylint: disable=not-callable
+    return r.scalar_one()
+
+
+async def _count(query: Select, session: AsyncSession) -> int:
+    """
+    Gets quantity of rows of query results. Only `_EXACT_COUNT_LIMIT + 1` rows are counted at most, so every page
+    of a long list doesn't scan all of it again (greater quantity means there are more than `_EXACT_COUNT_LIMIT`)
+    """
+    r = await session.execute(select(func.count()).select_from(  # pylint: disable=not-callable
+        query.limit(_EXACT_COUNT_LIMIT + 1).subquery()))
+    return r.scalar_one()
+
+
+def _visible_products(principal: auth.Principal) -> tuple[Select | None, ColumnElement]:
+    """
+    Query of products user is able to get (see `VerifiablePermissions.able_get_product`)
+    :return: Query (`None` if every product is visible) and column of product ID to order and paginate it by
+    """
+    if principal.permissions.can_read_other_products():
+        return None, models.Product.id
+    ownership = models.user_product_table
+    # Only own products are visible, they're walked through primary key of ownership in order of their IDs
+    query = select(models.Product).join(ownership, ownership.c.product_id == models.Product.id) \
+        .where(ownership.c.user_id == principal.id)
+    if not principal.permissions.can_manage_own_products():
+        query = query.where(false())
+    return query, ownership.c.product_id
+
+
+def _visible_users(principal: auth.Principal) -> Select | None:
+    """
+    Query of users visible to user: everyone if he can manage other users, otherwise himself and users created
+    by him or by his users (recursively) if he can manage own users, otherwise only himself
+    :return: Query (`None` if every user is visible)
+    """
+    if principal.permissions.can_manage_other_users():
+        return None
+    subtree = select(models.User.id).where(models.User.id == principal.id).cte("subtree", recursive=True)
+    if principal.permissions.can_manage_own_users():
+        subtree = subtree.union(select(models.User.id).where(models.User.master_id == subtree.c.id))
+    return select(models.User).join(subtree, subtree.c.id == models.User.id)
 
 
 @router.get("/product", response_model=schema.GetProduct)
 async def get_product(p_id: int = Query(alias="id"),
-                      session: AsyncSession = Depends(session_dep),
-                      current_user: schema.User = Depends(auth.get_current_user)):
+                      session: AsyncSession = Depends(read_session_dep),
+                      principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for getting product"""
     # Get product from DB
-    r = await session.execute(select(models.Product).filter_by(id=p_id).options(
-        selectinload(models.Product.signatures)))
+    r = await session.execute(select(models.Product).filter_by(id=p_id))
     p = r.scalar_one_or_none()
     if p is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_get_product(p):
+    if not principal.permissions.able_get_product(p):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # If all is ok, return product
     sig_period = p.sig_period.total_seconds() if p.sig_period is not None else None
     return schema.GetProduct(name=p.name, sig_install_limit=p.sig_install_limit,
                              sig_sessions_limit=p.sig_sessions_limit, sig_period=sig_period,
-                             additional_content=p.additional_content, id=p.id, signatures=len(p.signatures))
+                             additional_content=p.additional_content, id=p.id, signatures=p.signatures_count)
 
 
 @router.post("/product", response_model=schema.GetProduct)
 async def add_product(payload: schema.AddProduct,
                       session: AsyncSession = Depends(session_dep),
-                      current_user: schema.User = Depends(auth.get_current_user)):
+                      principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for adding product"""
     # Check if product with specified name already exists
     r = await session.execute(select(models.Product).filter_by(name=payload.name))
@@ -68,8 +143,7 @@ async def add_product(payload: schema.AddProduct,
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Product with specified name already exists")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_add_product():
+    if not principal.permissions.able_add_product():
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Create a product
     p = models.Product(name=payload.name,
@@ -78,10 +152,11 @@ async def add_product(payload: schema.AddProduct,
                        sig_period=timedelta(seconds=payload.sig_period) if payload.sig_period is not None else None,
                        additional_content=payload.additional_content)
     session.add(p)
+    await session.flush()
+    # User creating the product owns it
+    await session.execute(insert(models.user_product_table).values(user_id=principal.id, product_id=p.id))
     await session.commit()
-    await session.refresh(p)
-    user_in_db.owned_products.append(p)
-    await session.commit()
+    await auth.invalidate_user(principal.id)
     await session.refresh(p)
     await logger.info(f"Added new product \"{p.name}\" with id={p.id}")
     # Return this product
@@ -95,17 +170,15 @@ async def add_product(payload: schema.AddProduct,
 async def update_product(payload: schema.UpdateProduct,
                          p_id: int = Query(alias="id"),
                          session: AsyncSession = Depends(session_dep),
-                         current_user: schema.User = Depends(auth.get_current_user)):
+                         principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for updating existing product"""
     # Get product
-    r = await session.execute(select(models.Product).filter_by(id=p_id).options(
-        selectinload(models.Product.signatures)))
+    r = await session.execute(select(models.Product).filter_by(id=p_id))
     p = r.scalar_one_or_none()
     if p is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_edit_product(p):
+    if not principal.permissions.able_edit_product(p):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Check every field if it is filled (autofill mechanics here)
     if 'name' not in payload.unspecified_fields:
@@ -125,114 +198,167 @@ async def update_product(payload: schema.UpdateProduct,
         p.additional_content = copy(payload.additional_content)
     # Update the product
     await session.commit()
+    await lic_engine.invalidate_product(p.id)
     await session.refresh(p)
     sig_period = p.sig_period.total_seconds() if p.sig_period is not None else None
     await logger.info(f"Updated product \"{p.name}\" with id={p.id}")
     return schema.GetProduct(name=p.name, sig_install_limit=p.sig_install_limit,
                              sig_sessions_limit=p.sig_sessions_limit, sig_period=sig_period,
-                             additional_content=p.additional_content, id=p.id, signatures=len(p.signatures))
+                             additional_content=p.additional_content, id=p.id, signatures=p.signatures_count)
+
+
+async def _delete_product(p_id: int, session: AsyncSession, job_id: str | None = None):
+    """
+    Delete product with all its signatures (installations are deleted by cascade).
+    Signatures are deleted in chunks, every one in its own transaction, so none of them stays open for long
+    :param p_id: ID of product
+    :param session: AsyncSession of database
+    :param job_id: ID of background job to report progress to
+    """
+    deleted = 0
+    while True:
+        r = await session.execute(delete(models.Signature).where(models.Signature.id.in_(
+            select(models.Signature.id).filter_by(product_id=p_id).limit(config.DELETE_CHUNK_SIZE)))
+            .execution_options(synchronize_session=False))
+        await session.commit()
+        if not r.rowcount:
+            break
+        deleted += r.rowcount
+        if job_id is not None:
+            await jobs.report_progress(job_id, deleted)
+    await session.execute(delete(models.Product).filter_by(id=p_id).execution_options(synchronize_session=False))
+    await session.commit()
+    await lic_engine.invalidate_product(p_id)
 
 
-@router.delete("/product", response_model=schema.Successful)
-async def delete_product(p_id: int = Query(alias="id"),
+async def _delete_product_job(p_id: int, job_id: str):
+    """Delete product in background, outside of request's session"""
+    try:
+        async with jobs.holding_lease(job_id), db.create_session() as session:
+            await _delete_product(p_id, session, job_id)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        await logger.error(f"Failed to delete product with id={p_id}: {exc!r}")
+        await jobs.finish_job(job_id, error=repr(exc))
+        return
+    await jobs.finish_job(job_id)
+    await logger.info(f"Deleted product with id={p_id} in background")
+
+
+@router.delete("/product", response_model=schema.DeletionStarted, response_model_exclude_none=True)
+async def delete_product(background_tasks: BackgroundTasks,
+                         response: Response,
+                         p_id: int = Query(alias="id"),
                          session: AsyncSession = Depends(session_dep),
-                         current_user: schema.User = Depends(auth.get_current_user)):
-    """Request handler for deleting existing product"""
-    # Get product with all relations
-    r = await session.execute(select(models.Product).filter_by(id=p_id).options(
-        selectinload(models.Product.signatures).selectinload(models.Signature.installations)))
+                         principal: auth.Principal = Depends(auth.get_principal)):
+    """
+    Request handler for deleting existing product.
+    Products with many signatures are deleted in background, ID of the job is returned to track its progress
+    """
+    # Get product
+    r = await session.execute(select(models.Product).filter_by(id=p_id))
     p = r.scalar_one_or_none()
     if p is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_delete_product(p):
+    if not principal.permissions.able_delete_product(p):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
-    # Firstly clean signatures
-    for sig in p.signatures:
-        # And installations
-        for inst in sig.installations:
-            await session.delete(inst)
-        await session.delete(sig)
     p_name = p.name
     p_id = p.id
-    # Delete the product
-    await session.delete(p)
-    await session.commit()
+    if p.signatures_count > config.DELETE_CHUNK_SIZE:
+        job_id, created = await jobs.create_job("delete_product", p_id, p.signatures_count, principal.id)
+        if created:
+            background_tasks.add_task(_delete_product_job, p_id, job_id)
+            await logger.info(f"Started deletion of product \"{p_name}\" with id={p_id}, job_id={job_id}")
+        response.status_code = status.HTTP_202_ACCEPTED
+        return schema.DeletionStarted(job_id=job_id)
+    # Delete the product right away
+    await _delete_product(p_id, session)
     await logger.info(f"Deleted product \"{p_name}\" with id={p_id}")
-    return schema.Successful()  # Return {success: true}
+    return schema.DeletionStarted()  # Return {success: true}
+
+
+@router.get("/job", response_model=schema.Job)
+async def get_job(job_id: str = Query(alias="id"), principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for getting progress of background job started by user"""
+    job = await jobs.get_job(job_id)
+    # Jobs of other users are hidden
+    if job is None or (int(job["owner"]) != principal.id and not principal.permissions.is_superuser()):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return schema.Job(**job)
 
 
 @router.get("/list_products", response_model=schema.ListProducts)
-async def list_products(limit: int = 100, offset: int = 0, session: AsyncSession = Depends(session_dep)):
-    """Request handler for getting list of all products"""
-    # Get all products from DB
-    r = await session.execute(
-        select(models.Product).order_by(models.Product.id).offset(offset).limit(limit).options(
-            selectinload(models.Product.signatures)))
+async def list_products(pagination: Pagination = Depends(),
+                        session: AsyncSession = Depends(read_session_dep),
+                        principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for getting list of products visible to user"""
+    # Get visible products from DB
+    query, id_column = _visible_products(principal)
+    r = await session.execute(pagination.apply(query if query is not None else select(models.Product), id_column))
     p_list = []
     # List them
     for p in r.scalars():
         sig_period = p.sig_period.total_seconds() if p.sig_period is not None else None
         p_list.append(schema.ListedProduct(id=p.id, name=p.name, sig_install_limit=p.sig_install_limit,
                                            sig_sessions_limit=p.sig_sessions_limit, sig_period=sig_period,
-                                           signatures=len(p.signatures)))
-    return schema.ListProducts(products=p_list, items=len(p_list))
+                                           signatures=p.signatures_count))
+    return schema.ListProducts(products=p_list, items=len(p_list),
+                               total=await _estimate_count(models.Product, session) if query is None
+                               else await _count(query, session),
+                               next_cursor=pagination.next_cursor([p.id for p in p_list]))
 
 
 @router.get("/list_signatures", response_model=schema.ListSignatures)
 async def list_signatures(product_id: int,
-                          limit: int = 100,
-                          offset: int = 0,
-                          session: AsyncSession = Depends(session_dep),
-                          current_user: schema.User = Depends(auth.get_current_user)):
+                          pagination: Pagination = Depends(),
+                          session: AsyncSession = Depends(read_session_dep),
+                          principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for getting list of signatures of specified product"""
     # Get product from DB
     r = await session.execute(select(models.Product).filter_by(id=product_id))
     p = r.scalar_one_or_none()
     if p is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-    user_in_db = await _get_user_with_prod(current_user, session)
     # Check permission to perform this action
-    if not user_in_db.get_verifiable_permissions().able_get_product(p):
+    if not principal.permissions.able_get_product(p):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Get signatures
-    r = await session.execute(select(models.Signature).filter_by(product_id=product_id)
-                              .order_by(models.Signature.id).offset(offset).limit(limit))
+    r = await session.execute(pagination.apply(select(models.Signature).filter_by(product_id=product_id),
+                                               models.Signature.id))
     sig_list = []
     for sig in r.scalars():
         sig_list.append(schema.ShortSignature(comment=sig.comment, id=sig.id))
     # Return list of signatures
-    return schema.ListSignatures(items=len(sig_list), signatures=sig_list, product_id=product_id)
+    return schema.ListSignatures(items=len(sig_list), signatures=sig_list, product_id=product_id,
+                                 total=p.signatures_count,
+                                 next_cursor=pagination.next_cursor([sig.id for sig in sig_list]))
 
 
 @router.get("/signature", response_model=schema.GetSignature)
 async def get_signature(s_id: int = Query(alias="id"),
-                        session: AsyncSession = Depends(session_dep),
-                        current_user: schema.User = Depends(auth.get_current_user)):
+                        session: AsyncSession = Depends(read_session_dep),
+                        principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for getting signature info"""
     # Get signature from DB
     r = await session.execute(
-        select(models.Signature).filter_by(id=s_id).options(
-            selectinload(models.Signature.installations), selectinload(models.Signature.product)))
+        select(models.Signature).filter_by(id=s_id).options(selectinload(models.Signature.product)))
     sig = r.scalar_one_or_none()
     if sig is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Signature not found")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_get_product(sig.product):
+    if not principal.permissions.able_get_product(sig.product):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     act_date = None if sig.activation_date is None else sig.activation_date.isoformat()
     # Return signature
     return schema.GetSignature(id=sig.id, license_key=sig.license_key, additional_content=sig.additional_content,
-                               comment=sig.comment, installed=len(sig.installations), product_id=sig.product_id,
-                               activation_date=act_date)
+                               comment=sig.comment, installed=sig.installations_count,
+                               product_id=sig.product_id, activation_date=act_date)
 
 
 @router.post("/signature", response_model=schema.GetSignature)
 async def add_signature(payload: schema.AddSignature,
                         session: AsyncSession = Depends(session_dep),
-                        current_user: schema.User = Depends(auth.get_current_user)):
+                        principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for adding new signature of specified product"""
     # Check if there's a signature with the same license key
     r = await session.execute(select(models.Signature).filter_by(license_key=payload.license_key))
@@ -245,8 +371,7 @@ async def add_signature(payload: schema.AddSignature,
     if p is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_edit_product(p):
+    if not principal.permissions.able_edit_product(p):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Create signature
     sig = models.Signature(license_key=payload.license_key, additional_content=payload.additional_content,
@@ -262,22 +387,74 @@ async def add_signature(payload: schema.AddSignature,
                                comment=sig.comment, installed=0, product_id=sig.product_id, activation_date=act_date)
 
 
+@router.post("/signature/import", response_model=schema.ImportSignatures)
+async def import_signatures(request: Request,
+                            product_id: int,
+                            fmt: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+                            session: AsyncSession = Depends(session_dep),
+                            principal: auth.Principal = Depends(auth.get_principal)):
+    """
+    Request handler for importing signatures of specified product from request body streamed as CSV (with header)
+    or NDJSON. Every record has `license_key` and optionally `additional_content`, `comment` and `activate`
+    """
+    # Get product from DB
+    r = await session.execute(select(models.Product).filter_by(id=product_id))
+    p = r.scalar_one_or_none()
+    if p is None:  # If not exists
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    # Check permission to perform this action
+    if not principal.permissions.able_edit_product(p):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
+    # Import signatures while body is being received
+    start = perf_counter()
+    records = bulk.iter_csv(request.stream()) if fmt == "csv" else bulk.iter_ndjson(request.stream())
+    report = await bulk.import_signatures(product_id, records, session)
+    seconds = perf_counter() - start
+    keys_per_second = report.imported / seconds if seconds > 0 else 0.0
+    await logger.info(f"Imported {report.imported} signatures of product_id={product_id} "
+                      f"({keys_per_second:.0f} keys/s), conflicts: {report.conflicts}, invalid: {report.invalid}")
+    return schema.ImportSignatures(**asdict(report), seconds=seconds, keys_per_second=keys_per_second)
+
+
+@router.post("/signature/generate")
+async def generate_signatures(payload: schema.GenerateSignatures,
+                              session: AsyncSession = Depends(session_dep),
+                              principal: auth.Principal = Depends(auth.get_principal)):
+    """
+    Request handler for generating signatures of specified product with random license keys.
+    Created keys are streamed back one per line. If fewer keys than requested could be generated
+    (format is exhausted or database failed), the last line starts with `bulk.STREAM_ERROR` and explains it
+    """
+    # Get product from DB
+    r = await session.execute(select(models.Product).filter_by(id=payload.product_id))
+    p = r.scalar_one_or_none()
+    if p is None:  # If not exists
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    # Check permission to perform this action
+    if not principal.permissions.able_edit_product(p):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
+    # Keys must not be guessable
+    if bulk.key_entropy(payload.key_format) < bulk.MIN_KEY_ENTROPY:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Key format has too few random characters")
+    await logger.info(f"Generating {payload.count} signatures of product_id={payload.product_id}")
+    return StreamingResponse(bulk.generate_signatures(payload), media_type="text/plain")
+
+
 @router.put("/signature", response_model=schema.GetSignature)
 async def update_signature(payload: schema.UpdateSignature,
                            s_id: int = Query(alias="id"),
                            session: AsyncSession = Depends(session_dep),
-                           current_user: schema.User = Depends(auth.get_current_user)):
+                           principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for updating an existing signature"""
     # Get signature from db
     r = await session.execute(
-        select(models.Signature).filter_by(id=s_id).options(
-            selectinload(models.Signature.installations), selectinload(models.Signature.product)))
+        select(models.Signature).filter_by(id=s_id).options(selectinload(models.Signature.product)))
     sig = r.scalar_one_or_none()
     if sig is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Signature not found")
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_edit_product(sig.product):
+    if not principal.permissions.able_edit_product(sig.product):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Check every field if it is filled (autofill mechanics)
     if 'license_key' not in payload.unspecified_fields:
@@ -293,44 +470,171 @@ async def update_signature(payload: schema.UpdateSignature,
         sig.additional_content = copy(payload.additional_content)
     # Update signature
     await session.commit()
+    await lic_engine.invalidate_signature(sig.id)
     await session.refresh(sig)
     await logger.info(f"Updated signature with id={sig.id}")
     # Return signature
     act_date = None if sig.activation_date is None else sig.activation_date.isoformat()
     return schema.GetSignature(id=sig.id, license_key=sig.license_key, additional_content=sig.additional_content,
-                               comment=sig.comment, installed=len(sig.installations), product_id=sig.product_id,
-                               activation_date=act_date)
+                               comment=sig.comment, installed=sig.installations_count,
+                               product_id=sig.product_id, activation_date=act_date)
 
 
 @router.delete("/signature", response_model=schema.Successful)
 async def delete_signature(s_id: int = Query(alias="id"),
                            session: AsyncSession = Depends(session_dep),
-                           current_user: schema.User = Depends(auth.get_current_user)):
+                           principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for deleting an existing signature"""
     # Get signature form DB
-    r = await session.execute(select(models.Signature).filter_by(id=s_id))
+    r = await session.execute(select(models.Signature).filter_by(id=s_id).options(
+        selectinload(models.Signature.product)))
     sig = r.scalar_one_or_none()
     if sig is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Signature not found")
-    # If exists, get it with relations
-    r = await session.execute(select(models.Signature).filter_by(id=s_id)
-                              .options(selectinload(models.Signature.installations),
-                                       selectinload(models.Signature.product)))
-    sig = r.scalar_one_or_none()
     # Check permission to perform this action
-    user_in_db = await _get_user_with_prod(current_user, session)
-    if not user_in_db.get_verifiable_permissions().able_edit_product(sig.product):
+    if not principal.permissions.able_edit_product(sig.product):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
-    # Firstly delete all installations
-    for inst in sig.installations:
-        await session.delete(inst)
-    # Delete signature
-    await session.delete(sig)
+    # Delete signature (installations are deleted by cascade)
+    await session.execute(delete(models.Signature).filter_by(id=s_id).execution_options(synchronize_session=False))
     await session.commit()
+    await lic_engine.invalidate_signature(sig.id)
     await logger.info(f"Deleted signature with id={sig.id}")
     return schema.Successful()  # Return {success: true}
 
 
+_MIN_SEARCH_SUBSTRING = 3  # Shorter substrings of comments can't be looked up through trigram index
+
+
+def _escape_like(value: str) -> str:
+    """Escape wildcards of LIKE pattern"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class SearchCriteria:  # pylint: disable=too-few-public-methods
+    """
+    Query parameters of search of signatures: prefix of license key, substring of comment (case-insensitive),
+    fingerprint of installation and product. Specified criteria are combined, every one is backed by index
+    """
+
+    def __init__(self, license_key: str = None, comment: str = Query(None, min_length=_MIN_SEARCH_SUBSTRING),
+                 fingerprint: str = None, product_id: int = None):
+        if license_key is None and comment is None and fingerprint is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Specify license_key, comment or fingerprint")
+        self.license_key = license_key
+        self.comment = comment
+        self.fingerprint = fingerprint
+        self.product_id = product_id
+
+    def apply(self, query: Select) -> Select:
+        """Filter query of signatures"""
+        if self.license_key is not None:
+            query = query.where(models.Signature.license_key.like(_escape_like(self.license_key) + "%"))
+        if self.comment is not None:
+            query = query.where(models.Signature.comment.ilike("%" + _escape_like(self.comment) + "%"))
+        if self.fingerprint is not None:
+            query = query.where(models.Signature.id.in_(
+                select(models.Installation.signature_id).filter_by(fingerprint=self.fingerprint)))
+        if self.product_id is not None:
+            query = query.filter_by(product_id=self.product_id)
+        return query
+
+
+@router.get("/search", response_model=schema.SearchSignatures)
+async def search_signatures(criteria: SearchCriteria = Depends(),
+                            pagination: Pagination = Depends(),
+                            session: AsyncSession = Depends(read_session_dep),
+                            principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for searching signatures of products visible to user"""
+    query = criteria.apply(select(models.Signature))
+    # Only signatures of visible products are found
+    if not principal.permissions.can_read_other_products():
+        ownership = models.user_product_table
+        query = query.where(models.Signature.product_id.in_(
+            select(ownership.c.product_id).where(ownership.c.user_id == principal.id)))
+        if not principal.permissions.can_manage_own_products():
+            query = query.where(false())
+    r = await session.execute(pagination.apply(query, models.Signature.id))
+    sig_list = []
+    for sig in r.scalars():
+        sig_list.append(schema.FoundSignature(id=sig.id, product_id=sig.product_id, license_key=sig.license_key,
+                                              comment=sig.comment))
+    return schema.SearchSignatures(signatures=sig_list, items=len(sig_list),
+                                   next_cursor=pagination.next_cursor([sig.id for sig in sig_list]))
+
+
+_EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def _export_response(query: Select, fmt: str, name: str) -> StreamingResponse:
+    """Response streaming results of query as file, see `bulk.export_rows` for how failure is reported"""
+    return StreamingResponse(bulk.export_rows(query, fmt), media_type=_EXPORT_MEDIA_TYPES[fmt],
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'})
+
+
+async def _get_readable_product(product_id: int, principal: auth.Principal, session: AsyncSession) -> models.Product:
+    """Gets product checking permission of user to read it"""
+    r = await session.execute(select(models.Product).filter_by(id=product_id))
+    p = r.scalar_one_or_none()
+    if p is None:  # If not exists
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    if not principal.permissions.able_get_product(p):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
+    return p
+
+
+@router.get("/export/signatures")
+async def export_signatures(product_id: int,
+                            fmt: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+                            session: AsyncSession = Depends(read_session_dep),
+                            principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for streaming all signatures of specified product with quantities of their installations"""
+    await _get_readable_product(product_id, principal, session)
+    return _export_response(select(
+        models.Signature.id, models.Signature.license_key, models.Signature.additional_content,
+        models.Signature.comment, models.Signature.activation_date,
+        models.Signature.installations_count.label("installed"),
+    ).filter_by(product_id=product_id).order_by(models.Signature.id), fmt, f"signatures_{product_id}")
+
+
+@router.get("/export/installations")
+async def export_installations(product_id: int,
+                               fmt: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+                               session: AsyncSession = Depends(read_session_dep),
+                               principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for streaming all installations of signatures of specified product"""
+    await _get_readable_product(product_id, principal, session)
+    return _export_response(select(
+        models.Installation.id, models.Installation.signature_id, models.Signature.license_key,
+        models.Installation.fingerprint,
+    ).join(models.Signature, models.Installation.signature_id == models.Signature.id).where(
+        models.Signature.product_id == product_id).order_by(models.Installation.id), fmt,
+        f"installations_{product_id}")
+
+
+@router.get("/export/users")
+async def export_users(fmt: Literal["csv", "ndjson"] = Query("csv", alias="format"),
+                       principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for streaming all users visible to user"""
+    query = _visible_users(principal)
+    if query is None:
+        query = select(models.User)
+    return _export_response(query.with_only_columns(models.User.id, models.User.username, models.User.permissions,
+                                                    models.User.master_id).order_by(models.User.id), fmt, "users")
+
+
+@router.get("/metrics", response_model=schema.Metrics)
+async def metrics(principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for getting counters of current worker (to size caches, pools, etc.)"""
+    if not principal.permissions.is_superuser():
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
+    return schema.Metrics(**lic_engine.cache_stats(), principal_cache=auth.principal_cache.stats(),
+                          db_pool=db.pool_stats(),
+                          db_replica_pool=db.pool_stats(db.REPLICA_ENGINE) if db.REPLICA_ENGINE else None,
+                          write_behind_queue=await write_behind.queue_length() if config.WRITE_BEHIND else None,
+                          password_hashing=auth.hashing_stats())
+
+
 @public_router.post("/token", response_model=schema.Token)
 async def login_for_access_token(form_data: security.OAuth2PasswordRequestForm = Depends(),
                                  session: AsyncSession = Depends(session_dep)):
@@ -357,19 +661,24 @@ async def users_me(current_user: schema.User = Depends(auth.get_current_user)):
 
 
 @router.get("/users/list", response_model=schema.ListUsers)
-async def list_users(limit: int = 100, offset: int = 0, session: AsyncSession = Depends(session_dep)):
-    """Request handler for getting list of all users"""
-    r = await session.execute(select(models.User).order_by(models.User.id).offset(offset).limit(limit))
+async def list_users(pagination: Pagination = Depends(),
+                     session: AsyncSession = Depends(read_session_dep),
+                     principal: auth.Principal = Depends(auth.get_principal)):
+    """Request handler for getting list of users visible to user"""
+    query = _visible_users(principal)
+    r = await session.execute(pagination.apply(query if query is not None else select(models.User), models.User.id))
     users = []
-    # List all users
+    # List visible users
     for u in r.scalars():
         users.append(schema.User(id=u.id, username=u.username))
-    return schema.ListUsers(items=len(users), users=users)
+    total = await _estimate_count(models.User, session) if query is None else await _count(query, session)
+    return schema.ListUsers(items=len(users), users=users, total=total,
+                            next_cursor=pagination.next_cursor([u.id for u in users]))
 
 
 @router.get("/users/user", response_model=schema.ExpandedUser)
 async def get_user(u_id: int = Query(alias="id"),
-                   session: AsyncSession = Depends(session_dep)):
+                   session: AsyncSession = Depends(read_session_dep)):
     """Request handler for getting User by his ID"""
     # Get user from DB
     r = await session.execute(select(models.User).filter_by(id=u_id))
@@ -382,11 +691,10 @@ async def get_user(u_id: int = Query(alias="id"),
 @router.post("/users/user", response_model=schema.ExpandedUser)
 async def add_user(payload: schema.AddUser,
                    session: AsyncSession = Depends(session_dep),
-                   current_user: schema.User = Depends(auth.get_current_user)):
+                   principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for adding new user with specified parameters"""
     # Check permission to perform this action
-    current_user_in_db = await _get_user(current_user, session)
-    if not current_user_in_db.get_verifiable_permissions().able_add_user(payload.permissions):
+    if not principal.permissions.able_add_user(payload.permissions):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Check if someone already has this username
     r = await session.execute(select(models.User).filter_by(username=payload.username))
@@ -394,9 +702,9 @@ async def add_user(payload: schema.AddUser,
         raise HTTPException(status_code=409, detail="User with specified username already exists")
     # Create user
     u = models.User(username=payload.username,
-                    hashed_password=auth.get_password_hash(payload.password),
+                    hashed_password=await auth.hash_password(payload.password),
                     permissions=payload.permissions,
-                    master_id=current_user_in_db.id)
+                    master_id=principal.id)
     session.add(u)
     await session.commit()
     await session.refresh(u)
@@ -408,7 +716,7 @@ async def add_user(payload: schema.AddUser,
 async def update_user(payload: schema.UpdateUser,
                       u_id: int = Query(alias="id"),
                       session: AsyncSession = Depends(session_dep),
-                      current_user: schema.User = Depends(auth.get_current_user)):
+                      principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for updating an existing user"""
     # Get user form db
     r = await session.execute(select(models.User).filter_by(id=u_id))
@@ -416,8 +724,7 @@ async def update_user(payload: schema.UpdateUser,
     if u is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     # Check permission to perform this action
-    current_user_in_db = await _get_user(current_user, session)
-    if not current_user_in_db.get_verifiable_permissions().able_edit_user(u, payload.permissions):
+    if not principal.permissions.able_edit_user(u, payload.permissions):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Check every field if it is filled (autofill mechanics)
     if 'username' not in payload.unspecified_fields:
@@ -427,10 +734,11 @@ async def update_user(payload: schema.UpdateUser,
             raise HTTPException(status_code=409, detail="User with specified username already exists")
         u.username = copy(payload.username)
     if 'password' not in payload.unspecified_fields:
-        u.hashed_password = auth.get_password_hash(payload.password)
+        u.hashed_password = await auth.hash_password(payload.password)
     if 'permissions' not in payload.unspecified_fields:
         u.permissions = copy(payload.permissions)
     await session.commit()
+    await auth.invalidate_user(u.id)
     await session.refresh(u)
     # Return user
     return schema.ExpandedUser(id=u.id, username=u.username, master_id=u.master_id, permissions=u.permissions)
@@ -439,7 +747,7 @@ async def update_user(payload: schema.UpdateUser,
 @router.delete("/users/user", response_model=schema.Successful)
 async def delete_user(u_id: int = Query(alias="id"),
                       session: AsyncSession = Depends(session_dep),
-                      current_user: schema.User = Depends(auth.get_current_user)):
+                      principal: auth.Principal = Depends(auth.get_principal)):
     """Request handler for deleting an existing user"""
     # Get user from DB
     r = await session.execute(select(models.User).filter_by(id=u_id))
@@ -447,10 +755,10 @@ async def delete_user(u_id: int = Query(alias="id"),
     if u is None:  # If not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
     # Check every field if it is filled (autofill mechanics)
-    current_user_in_db = await _get_user(current_user, session)
-    if not current_user_in_db.get_verifiable_permissions().able_delete_user(u):
+    if not principal.permissions.able_delete_user(u):
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You have no permission")
     # Delete user
     await session.delete(u)
     await session.commit()
+    await auth.invalidate_user(u_id)
     return schema.Successful()  # Return {success: true}
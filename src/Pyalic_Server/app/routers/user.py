@@ -1,41 +1,56 @@
 """
 User's api for checking license and managing session
 """
-from fastapi import APIRouter, HTTPException, status, Depends
+from contextlib import suppress
+from fastapi import APIRouter, HTTPException, status, Depends, Body, WebSocket
 from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
 
-from .. import schema
+from .. import schema, config
 from ..licensing import engine as lic_engine
 from ..licensing import sessions as lic_sessions
-from ..db import session_dep, models
+from ..db import session_dep, read_session_dep
 from ..loggers import logger
 
 router = APIRouter()
 
 
 @router.post("/check_license")
-async def check_license(payload: schema.CheckLicense, session: AsyncSession = Depends(session_dep)):
+async def check_license(payload: schema.CheckLicense, session: AsyncSession = Depends(session_dep),
+                        read_session: AsyncSession = Depends(read_session_dep)):
     """Request handler for checking license and creating a new Session with ID"""
     # Process check request via licensing engine
-    check_resp = await lic_engine.process_check_request(payload.license_key, payload.fingerprint, session)
+    check_resp = await lic_engine.process_check_request(payload.license_key, payload.fingerprint, session,
+                                                        read_session)
     if check_resp.success:  # If access granted
-        # Get signature
-        r = await session.execute(select(models.Signature).filter_by(license_key=payload.license_key).options(
-            selectinload(models.Signature.product)))
-        sig = r.scalar_one_or_none()
-        if sig is None:  # If signature not exists
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST)
-        return schema.GoodLicense(session_id=check_resp.session_id, additional_content_signature=sig.additional_content,
-                                  additional_content_product=sig.product.additional_content)
+        return schema.GoodLicense(session_id=check_resp.session_id,
+                                  additional_content_signature=check_resp.additional_content_signature,
+                                  additional_content_product=check_resp.additional_content_product)
     # If something went wrong
     await logger.warning(f"Access denied (key={payload.license_key}), message: {check_resp.error}")
     resp = schema.BadLicense(error=check_resp.error)
     return JSONResponse(content=resp.model_dump(), status_code=403)
 
 
+@router.post("/check_license/batch", response_model=list[schema.GoodLicense | schema.BadLicense])
+async def check_license_batch(payload: list[schema.CheckLicense] = Body(max_length=config.BATCH_LIMIT),
+                              session: AsyncSession = Depends(session_dep),
+                              read_session: AsyncSession = Depends(read_session_dep)):
+    """Request handler for checking many licenses at once (i.e. by client having keys of several products)"""
+    check_responses = await lic_engine.process_check_requests(
+        [(item.license_key, item.fingerprint) for item in payload], session, read_session)
+    res = []
+    for item, check_resp in zip(payload, check_responses):
+        if check_resp.success:  # If access granted
+            res.append(schema.GoodLicense(session_id=check_resp.session_id,
+                                          additional_content_signature=check_resp.additional_content_signature,
+                                          additional_content_product=check_resp.additional_content_product))
+        else:  # If something went wrong
+            await logger.warning(f"Access denied (key={item.license_key}), message: {check_resp.error}")
+            res.append(schema.BadLicense(error=check_resp.error))
+    return res
+
+
 @router.post("/keepalive", response_model=schema.Successful)
 async def keepalive(payload: schema.SessionIdField):
     """Request handler for processing keep-alive sessions"""
@@ -47,6 +62,13 @@ async def keepalive(payload: schema.SessionIdField):
     return schema.Successful()  # Return {success: true}
 
 
+@router.post("/keepalive/batch", response_model=schema.SessionsStatus)
+async def keepalive_batch(payload: schema.SessionIdsField):
+    """Request handler for processing keep-alive of many sessions at once (i.e. by gateway of many clients)"""
+    alive = await lic_sessions.keep_alive_many(payload.session_ids)
+    return schema.SessionsStatus(sessions=dict(zip(payload.session_ids, alive)))
+
+
 @router.post("/end_session", response_model=schema.Successful)
 async def end_session(payload: schema.SessionIdField):
     """Request handler for correctly ending session by Session ID"""
@@ -56,3 +78,23 @@ async def end_session(payload: schema.SessionIdField):
         # If session not exists
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Session not found") from exc
     return schema.Successful()  # Return {success: true}
+
+
+@router.websocket("/session")
+async def session_channel(websocket: WebSocket, session_id: str):
+    """
+    Channel keeping session alive while it's open: every received frame is a keep-alive signal.
+    Session is ended when client disconnects
+    """
+    await websocket.accept()
+    while True:
+        try:
+            await lic_sessions.keep_alive(session_id)  # Pass keepalive signal to licensing engine
+        except lic_sessions.SessionNotFoundException:
+            # If session not exists
+            await websocket.close(code=4404, reason="Session not found")
+            return
+        if (await websocket.receive())["type"] == "websocket.disconnect":
+            break
+    with suppress(lic_sessions.SessionNotFoundException):
+        await lic_sessions.end_session(session_id)  # Pass end signal to licensing engine
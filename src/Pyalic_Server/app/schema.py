@@ -2,7 +2,9 @@
 Pydantic schemas
 """
 from typing import Any
-from pydantic import BaseModel  # pylint: disable=no-name-in-module
+from pydantic import BaseModel, Field  # pylint: disable=no-name-in-module
+
+from . import config
 
 
 class UnspecifiedModel(BaseModel):
@@ -57,9 +59,24 @@ class Successful(BaseModel):
     success: bool = True
 
 
+class DeletionStarted(Successful):
+    job_id: str = None  # Specified if deletion continues in background
+
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    status: str
+    total: int
+    done: int
+    error: str = None
+
+
 class ListProducts(BaseModel):
     products: list[ListedProduct]
     items: int
+    total: int  # Estimated if there are many rows (lists filtered by permissions count up to 10001 rows)
+    next_cursor: str = None  # Pass it as `cursor` to get the next page
 
 
 class ShortSignature(BaseModel):
@@ -83,6 +100,25 @@ class AddSignature(BaseModel):
     activate: bool = False
 
 
+class GenerateSignatures(BaseModel):
+    product_id: int
+    count: int = Field(gt=0, le=config.GENERATE_LIMIT)
+    key_format: str = "XXXXX-XXXXX-XXXXX-XXXXX-XXXXX"  # Every X is replaced by random character
+    additional_content: str = ""
+    comment: str = ""
+    activate: bool = False
+
+
+class ImportSignatures(BaseModel):
+    imported: int
+    conflicts: int
+    conflicting_keys: list[str]
+    invalid: int
+    invalid_lines: list[int]
+    seconds: float
+    keys_per_second: float
+
+
 class UpdateSignature(UnspecifiedModel):
     comment: str = None
     license_key: str = None
@@ -93,6 +129,19 @@ class ListSignatures(BaseModel):
     signatures: list[ShortSignature]
     product_id: int
     items: int
+    total: int  # Exact, counter of product signatures is maintained by database trigger
+    next_cursor: str = None  # Pass it as `cursor` to get the next page
+
+
+class FoundSignature(ShortSignature):
+    product_id: int
+    license_key: str
+
+
+class SearchSignatures(BaseModel):
+    signatures: list[FoundSignature]
+    items: int
+    next_cursor: str = None  # Pass it as `cursor` to get the next page
 
 
 class CheckLicense(BaseModel):
@@ -116,6 +165,14 @@ class SessionIdField(BaseModel):
     session_id: str
 
 
+class SessionIdsField(BaseModel):
+    session_ids: list[str] = Field(max_length=config.KEEPALIVE_BATCH_LIMIT)
+
+
+class SessionsStatus(BaseModel):
+    sessions: dict[str, bool]
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -141,6 +198,8 @@ class ExpandedUser(UserWithMaster):
 class ListUsers(BaseModel):
     users: list[User]
     items: int
+    total: int  # Estimated if there are many rows (lists filtered by permissions count up to 10001 rows)
+    next_cursor: str = None  # Pass it as `cursor` to get the next page
 
 
 class AddUser(BaseModel):
@@ -153,3 +212,35 @@ class UpdateUser(UnspecifiedModel):
     username: str = None
     permissions: str = None
     password: str = None
+
+
+class CacheStats(BaseModel):
+    entries: int
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+class DbPoolStats(BaseModel):
+    size: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    wait_time: float
+
+
+class PasswordHashingStats(BaseModel):
+    workers: int
+    running: int
+    queued: int
+
+
+class Metrics(BaseModel):
+    license_cache: CacheStats
+    installations_cache: CacheStats
+    principal_cache: CacheStats
+    db_pool: DbPoolStats
+    db_replica_pool: DbPoolStats = None
+    write_behind_queue: int = None  # Installations waiting to be written to database
+    password_hashing: PasswordHashingStats
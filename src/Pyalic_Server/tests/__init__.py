@@ -62,16 +62,19 @@ def load_db_state():
 
 def clean_db():
     """
-    Drop all models in database
+    Drop all models in database (and history of migrations)
     """
     db.SqlAlchemyBase.metadata.drop_all(bind=ENGINE)
+    with ENGINE.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS alembic_version"))
 
 
 def fill_db():
     """
-    Create all models in database
+    Create all models in database by migrations (as the server does), so triggers and indexes are tested too
     """
-    db.SqlAlchemyBase.metadata.create_all(bind=ENGINE)
+    with ENGINE.begin() as conn:
+        db.migrate(conn)
 
 
 def rand_str(length: int) -> str:
@@ -6,7 +6,8 @@ import pytest
 from fastapi.testclient import TestClient
 from redis import Redis
 
-from ..app import config, app
+from ..app import config, app, db
+from ..app.access.auth import principal_cache
 
 from . import load_db_state, save_db_state, clean_db, fill_db
 
@@ -23,9 +24,10 @@ def client() -> TestClient:
 
 
 @pytest.fixture(scope="function")
-def rebuild_db(redis_client):  # pylint: disable=W0621
+def rebuild_db(client, redis_client):  # pylint: disable=W0621
     """
     Rebuild db with saved state
+    :param client:
     :param redis_client:
     :return:
     """
@@ -33,6 +35,11 @@ def rebuild_db(redis_client):  # pylint: disable=W0621
     clean_db()
     fill_db()
     load_db_state()
+    principal_cache.clear()  # Users are changed in database directly
+    # Recreated tables invalidate statements prepared by pooled connections, so they're reopened
+    for engine in (db.ENGINE, db.REPLICA_ENGINE):
+        if engine is not None:
+            client.portal.call(engine.dispose)
 
 
 @pytest.fixture(scope="session")
@@ -1,12 +1,17 @@
 """
 Test all about access management and authorization
 """
+import json
+from concurrent.futures import ThreadPoolExecutor
 import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..app import config
+from ..app import config, db
 from ..app.db import models
+from ..app.routers import admin
 from ..app.access.auth import check_password
 from ..app.access.auth import get_password_hash
+from ..app.access.auth import get_principal, invalidate_user, principal_cache
 
 from . import rand_str, create_db_session
 
@@ -63,6 +68,16 @@ class TestAuth:
         assert 'access_token' not in r.json().keys()
         assert 'token_type' not in r.json().keys()
 
+    def test_concurrent_logins(self, client):
+        """Passwords verified concurrently by the pool of hashing workers must give the right results"""
+        def login(password: str) -> int:
+            return client.request('POST', '/admin/token', data={
+                "grant_type": "password", "username": config.DEFAULT_USER, "password": password}).status_code
+
+        passwords = [config.DEFAULT_PASSWORD, rand_str(16)] * 8
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            assert list(executor.map(login, passwords)) == [200, 401] * 8
+
     def test_wrong_user(self, client):  # pylint: disable=C0116
         p = {
             "grant_type": "password",
@@ -203,9 +218,64 @@ class TestUsersOperations:
         r = client.request('DELETE', '/admin/users/user', params=p, headers=auth)
         assert r.status_code == 404 and r.json()['detail'] == 'User not found'
 
+    def test_principal_invalidated_while_read(self, client, auth):
+        """Principal read before the user was invalidated mustn't be cached"""
+        token = auth['Authorization'].split()[1]
+        user_id = client.request('GET', '/admin/users/me', headers=auth).json()['id']
+
+        async def get_principal_invalidated_meanwhile():
+            async with AsyncSession(db.ENGINE) as session:
+                execute = session.execute
+
+                async def execute_and_invalidate(*args, **kwargs):
+                    res = await execute(*args, **kwargs)
+                    await invalidate_user(user_id)
+                    return res
+
+                session.execute = execute_and_invalidate
+                return await get_principal(token, session)
+
+        principal_cache.clear()
+        assert client.portal.call(get_principal_invalidated_meanwhile).id == user_id
+        assert principal_cache.get(token) is None
+        client.request('GET', '/admin/users/me', headers=auth)
+        assert principal_cache.get(token).id == user_id
+
+    def test_cached_principal_invalidation(self, client, auth):
+        """Cached principal must be dropped as soon as the user or his products are changed"""
+        username = rand_str(16)
+        password = rand_str(16)
+        p = {
+            "username": username,
+            "password": password,
+            "permissions": "manage_own_products"
+        }
+        u_id = client.request('POST', '/admin/users/user', json=p, headers=auth).json()['id']
+        r = client.request('POST', '/admin/token', data={"grant_type": "password", "username": username,
+                                                         "password": password})
+        user_auth = {'Authorization': f"Bearer {r.json()['access_token']}"}
+        # Created product is owned at once
+        r = client.request('POST', '/admin/product', json={"name": rand_str(16)}, headers=user_auth)
+        assert r.status_code == 200
+        product_id = r.json()['id']
+        hits = client.request('GET', '/admin/metrics', headers=auth).json()['principal_cache']['hits']
+        r = client.request('GET', '/admin/product', params={'id': product_id}, headers=user_auth)
+        assert r.status_code == 200
+        assert client.request('GET', '/admin/metrics', headers=auth).json()['principal_cache']['hits'] > hits
+        # Withdrawn permissions are applied at once
+        r = client.request('PUT', '/admin/users/user', json={"permissions": ""}, params={'id': u_id}, headers=auth)
+        assert r.status_code == 200
+        r = client.request('GET', '/admin/product', params={'id': product_id}, headers=user_auth)
+        assert r.status_code == 403
+        # Deleted user is logged out at once
+        r = client.request('DELETE', '/admin/users/user', params={'id': u_id}, headers=auth)
+        assert r.status_code == 200
+        r = client.request('GET', '/admin/users/me', headers=user_auth)
+        assert r.status_code == 401
+
 
 @pytest.mark.usefixtures('client', 'rebuild_db', 'auth')
-class TestUserPermissions:
+class TestUserPermissions:  # pylint: disable=too-many-public-methods
     """
     Test permissions; What user can or cannot do
     """
@@ -469,3 +539,93 @@ class TestUserPermissions:
         # Try to update him
         r = client.request('PUT', '/admin/users/user', json=p, params={'id': u_id}, headers=auth)
         assert r.status_code == 403  # Must fail
+
+    def test_list_own_products(self, client, auth):  # pylint: disable=C0116
+        self.__set_default_user_permissions("manage_own_products")
+        other_id = _create_rand_product_with_user()
+        r = client.request('POST', '/admin/product', json={"name": rand_str(16)}, headers=auth)
+        own_id = r.json()['id']
+        r = client.request('GET', '/admin/list_products', params={"limit": 100}, headers=auth)
+        assert r.status_code == 200
+        ids = [p['id'] for p in r.json()['products']]
+        assert own_id in ids and other_id not in ids
+        assert r.json()['total'] == len(ids)
+
+    def test_list_many_own_products(self, client, auth, monkeypatch):
+        """Long filtered lists are counted only up to the limit of exact count"""
+        monkeypatch.setattr(admin, "_EXACT_COUNT_LIMIT", 2)
+        self.__set_default_user_permissions("manage_own_products")
+        for _ in range(5):
+            client.request('POST', '/admin/product', json={"name": rand_str(16)}, headers=auth)
+        r = client.request('GET', '/admin/list_products', params={"limit": 2}, headers=auth)
+        assert r.status_code == 200
+        assert len(r.json()['products']) == 2 and r.json()['total'] == 3
+
+    def test_metrics_abuse(self, client, auth):  # pylint: disable=C0116
+        self.__set_default_user_permissions("manage_own_products,manage_own_users")
+        r = client.request('GET', '/admin/metrics', headers=auth)
+        assert r.status_code == 403
+
+    def test_list_products_abuse(self, client, auth):  # pylint: disable=C0116
+        self.__set_default_user_permissions("")
+        with create_db_session() as session:
+            u = session.query(models.User).filter_by(username=config.DEFAULT_USER).one_or_none()
+            p = models.Product(name=rand_str(16))
+            p.owners.append(u)
+            session.add(p)
+            session.commit()
+        r = client.request('GET', '/admin/list_products', params={"limit": 100}, headers=auth)
+        assert r.status_code == 200
+        assert r.json()['products'] == [] and r.json()['total'] == 0
+
+    def test_list_own_users(self, client, auth):  # pylint: disable=C0116
+        self.__set_default_user_permissions("manage_own_users")
+        with create_db_session() as session:
+            me = session.query(models.User).filter_by(username=config.DEFAULT_USER).one_or_none()
+            slave = models.User(username=rand_str(16), hashed_password="", permissions="", master_id=me.id)
+            other = models.User(username=rand_str(16), hashed_password="", permissions="")
+            session.add_all([slave, other])
+            session.commit()
+            # Users created by own users are own too
+            slave_of_slave = models.User(username=rand_str(16), hashed_password="", permissions="",
+                                         master_id=slave.id)
+            session.add(slave_of_slave)
+            session.commit()
+            visible = {me.id, slave.id, slave_of_slave.id}
+            other_id = other.id
+        r = client.request('GET', '/admin/users/list', params={"limit": 100}, headers=auth)
+        assert r.status_code == 200
+        ids = {u['id'] for u in r.json()['users']}
+        assert visible <= ids and other_id not in ids
+        assert r.json()['total'] == len(ids)
+
+    def test_list_users_abuse(self, client, auth):  # pylint: disable=C0116
+        self.__set_default_user_permissions("")
+        r = client.request('GET', '/admin/users/list', params={"limit": 100}, headers=auth)
+        assert r.status_code == 200
+        assert [u['username'] for u in r.json()['users']] == [config.DEFAULT_USER]
+
+    def test_export_users_abuse(self, client, auth):  # pylint: disable=C0116
+        self.__set_default_user_permissions("")
+        with create_db_session() as session:
+            session.add(models.User(username=rand_str(16), hashed_password="", permissions=""))
+            session.commit()
+        r = client.request('GET', '/admin/export/users', params={"format": "ndjson"}, headers=auth)
+        assert r.status_code == 200
+        assert [json.loads(line)['username'] for line in r.text.splitlines()] == [config.DEFAULT_USER]
+
+    def test_manage_many_own_products(self, client, auth):
+        """User owning many products must be able to manage every one of them and nothing else"""
+        self.__set_default_user_permissions("manage_own_products")
+        with create_db_session() as session:
+            u = session.query(models.User).filter_by(username=config.DEFAULT_USER).one()
+            u.owned_products.extend(models.Product(name=rand_str(16)) for _ in range(200))
+            session.commit()
+            owned = [p.id for p in u.owned_products]
+        other_id = _create_rand_product_with_user()
+        for product_id in (owned[0], owned[-1]):
+            r = client.request('PUT', '/admin/product', json={"name": rand_str(16)}, params={'id': product_id},
+                               headers=auth)
+            assert r.status_code == 200
+        r = client.request('PUT', '/admin/product', json={"name": rand_str(16)}, params={'id': other_id}, headers=auth)
+        assert r.status_code == 403
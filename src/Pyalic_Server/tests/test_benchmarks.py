@@ -0,0 +1,273 @@
+"""
+Benchmarks of hot paths. Each test prints measured values and fails if scaling regresses.
+They depend on timings of the machine, so they're skipped unless BENCHMARKS=1 is set
+"""
+import os
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from string import ascii_letters, digits
+import pytest
+from fastapi import Depends
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from ..app import app, config, db
+from ..app.db import models
+from ..app.access.auth import get_password_hash
+from ..app.access.permissions import DEFAULT_PERMISSIONS, VerifiablePermissions
+from ..app.licensing import sessions, engine as lic_engine
+
+from . import rand_str, create_db_session
+
+
+def _measure(func, repeat: int) -> float:
+    """
+    Measure average time of calling function
+    :param func: Function to be called
+    :param repeat: How many times to call it
+    :return: Average time in seconds
+    """
+    func()  # Warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+benchmark = pytest.mark.skipif(not os.environ.get('BENCHMARKS'), reason="Set BENCHMARKS=1 to run")
+
+
+# pylint: disable=C0116
+
+@benchmark
+@pytest.mark.usefixtures('client', 'rebuild_db')
+class TestCheckLicenseBenchmarks:  # pylint: disable=C0115
+    def test_check_latency_by_installations(self, client):
+        """Latency of checking license must not depend on how many installations the signature has"""
+        with create_db_session() as session:
+            p = models.Product(name=rand_str(16), sig_install_limit=1_000_000)
+            session.add(p)
+            session.commit()
+            s = models.Signature(product_id=p.id, license_key=rand_str(32))
+            session.add(s)
+            session.commit()
+            signature_id, key = s.id, s.license_key
+        payload = {
+            "license_key": key,
+            "fingerprint": rand_str(16)
+        }
+        results = {}
+        installed = 0
+        for installations in (10, 1000, 20000):
+            with create_db_session() as session:
+                session.execute(insert(models.Installation), [
+                    {"signature_id": signature_id, "fingerprint": rand_str(16)}
+                    for _ in range(installations - installed)])
+                session.commit()
+            installed = installations
+            results[installations] = _measure(
+                lambda: client.request('POST', '/check_license', json=payload), repeat=50)
+        print("\nAverage /check_license latency by installations:",
+              ", ".join(f"{k}: {v * 1000:.2f}ms" for k, v in results.items()))
+        assert results[20000] < results[10] * 2 + 0.005
+
+    def test_check_latency_by_pool(self, client):
+        """Checking license through pooled connections must be faster than opening connection every time"""
+        with create_db_session() as session:
+            p = models.Product(name=rand_str(16), sig_install_limit=10)
+            session.add(p)
+            session.commit()
+            s = models.Signature(product_id=p.id, license_key=rand_str(32))
+            session.add(s)
+            session.commit()
+            key = s.license_key
+        payload = {
+            "license_key": key,
+            "fingerprint": rand_str(16)
+        }
+
+        def check():
+            # Don't let cache hide database
+            lic_engine.license_cache.clear()
+            lic_engine.installations_cache.clear()
+            assert client.request('POST', '/check_license', json=payload).status_code == 200
+
+        def measure(pool_size: int) -> float:
+            engine = db.create_engine(config.DB_USER, config.DB_PASSWORD, config.DB_HOST, config.DB_NAME, pool_size)
+            factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+
+            async def session_dep():
+                async with factory() as session:
+                    yield session
+
+            async def read_session_dep(session: AsyncSession = Depends(session_dep)):
+                yield session  # Replica is left out, only pools are compared
+
+            app.dependency_overrides.update({db.session_dep: session_dep, db.read_session_dep: read_session_dep})
+            try:
+                return _measure(check, repeat=100)
+            finally:
+                app.dependency_overrides.clear()
+                client.portal.call(engine.dispose)
+
+        results = {pool_size: measure(pool_size) for pool_size in (0, 5)}
+        print(f"\nAverage /check_license latency: NullPool {results[0] * 1000:.2f}ms, pool {results[5] * 1000:.2f}ms")
+        assert results[5] < results[0]
+
+
+def _legacy_session_id(signature_id: int, signature_ends: int) -> str:
+    """Unsigned Session ID as it was generated before"""
+    return f"{str(signature_id)}:{signature_ends}:" + "".join(
+        [random.choice(ascii_letters + digits) for _ in range(32)])
+
+
+@benchmark
+class TestSessionIdBenchmarks:  # pylint: disable=C0115
+    def test_session_id_generation(self):
+        """Generating and verifying signed Session ID must be cheaper than generating the legacy one"""
+        session_id = sessions._random_session_id(1, 0)  # pylint: disable=protected-access
+        legacy = _measure(lambda: _legacy_session_id(1, 0), repeat=20000)
+        generation = _measure(lambda: sessions._random_session_id(1, 0), repeat=20000)  # pylint: disable=W0212
+        verification = _measure(lambda: sessions._parse_session_id(session_id), repeat=20000)  # pylint: disable=W0212
+        print(f"\nSession ID: legacy generation {legacy * 1e6:.2f}us, generation {generation * 1e6:.2f}us, "
+              f"verification {verification * 1e6:.2f}us")
+        assert generation + verification < legacy
+
+
+@benchmark
+class TestPermissionsBenchmarks:  # pylint: disable=C0115
+    def test_ownership_check_by_owned_products(self):
+        """Checking permission for a product must not depend on how many products the user owns"""
+        legacy, results = {}, {}
+        for owned in (10, 10000):
+            products = [models.Product(id=i) for i in range(owned)]
+            permissions = VerifiablePermissions(1, DEFAULT_PERMISSIONS, frozenset(p.id for p in products))
+            # Products were looked up in loaded collection of owned ones before
+            legacy[owned] = _measure(lambda products=products: products[-1] in products, repeat=2000)
+            results[owned] = _measure(lambda permissions=permissions, products=products: permissions.able_edit_product(
+                products[-1]), repeat=20000)
+        print("\nAverage product permission check by owned products:",
+              ", ".join(f"{k}: {v * 1e6:.2f}us (legacy {legacy[k] * 1e6:.2f}us)" for k, v in results.items()))
+        assert results[10000] < results[10] * 2 + 1e-6
+        assert results[10000] < legacy[10000]
+
+    @pytest.mark.usefixtures('client', 'rebuild_db')
+    def test_product_access_latency_by_owned_products(self, client):
+        """Latency of admin requests must not depend on how many products the user owns"""
+        results = {}
+        for owned in (10, 5000):
+            username, password = rand_str(16), rand_str(16)
+            with create_db_session() as session:
+                u = models.User(username=username, hashed_password=get_password_hash(password))
+                session.add(u)
+                session.commit()
+                session.execute(text("INSERT INTO products (name, additional_content) "
+                                     "SELECT :prefix || g, '' FROM generate_series(1, :n) g"),
+                                {"prefix": rand_str(16), "n": owned})
+                session.execute(text("INSERT INTO user_product (user_id, product_id) "
+                                     "SELECT :user_id, id FROM products ORDER BY id DESC LIMIT :n"),
+                                {"user_id": u.id, "n": owned})
+                product_id = session.execute(text("SELECT max(id) FROM products")).scalar()
+                session.commit()
+            r = client.request('POST', '/admin/token', data={"grant_type": "password", "username": username,
+                                                             "password": password})
+            headers = {'Authorization': f"Bearer {r.json()['access_token']}"}
+            results[owned] = _measure(lambda headers=headers, product_id=product_id: client.request(
+                'GET', '/admin/product', params={"id": product_id}, headers=headers), repeat=50)
+        print("\nAverage GET /admin/product latency by owned products:",
+              ", ".join(f"{k}: {v * 1000:.2f}ms" for k, v in results.items()))
+        assert results[5000] < results[10] * 2 + 0.005
+
+
+@benchmark
+@pytest.mark.usefixtures('client', 'rebuild_db')
+class TestPasswordHashingBenchmarks:  # pylint: disable=C0115
+    def test_keepalive_latency_during_logins(self, client):
+        """Burst of logins must not stall other requests while passwords are being verified"""
+        with create_db_session() as session:
+            p = models.Product(name=rand_str(16))
+            session.add(p)
+            session.commit()
+            s = models.Signature(product_id=p.id, license_key=rand_str(32))
+            session.add(s)
+            session.commit()
+            key = s.license_key
+        session_id = client.request('POST', '/check_license', json={
+            "license_key": key, "fingerprint": rand_str(16)}).json()["session_id"]
+
+        def keepalive() -> float:
+            start = time.perf_counter()
+            assert client.request('POST', '/keepalive', json={"session_id": session_id}).status_code == 200
+            return time.perf_counter() - start
+
+        def login() -> float:
+            start = time.perf_counter()
+            assert client.request('POST', '/admin/token', data={
+                "grant_type": "password", "username": config.DEFAULT_USER, "password": config.DEFAULT_PASSWORD
+            }).status_code == 200
+            return time.perf_counter() - start
+
+        idle = _measure(keepalive, repeat=20)
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            logins = [executor.submit(login) for _ in range(16)]
+            during = [keepalive() for _ in range(20)]
+            login_times = [f.result() for f in logins]
+        print(f"\n/keepalive latency: idle {idle * 1000:.2f}ms, during logins max {max(during) * 1000:.2f}ms; "
+              f"average login {sum(login_times) / len(login_times) * 1000:.2f}ms")
+        # If bcrypt ran on event loop, keepalive would wait for several hashes in a row
+        assert max(during) < max(login_times) / 2
+
+
+@pytest.mark.skipif(not os.environ.get('LARGE_BENCHMARKS'), reason="Set LARGE_BENCHMARKS=1 to run")
+@pytest.mark.usefixtures('client', 'rebuild_db', 'auth')
+class TestLargeDatasetBenchmarks:  # pylint: disable=C0115
+    def test_hot_lookup_indexes(self, client, auth):
+        """Latency of checking license, listing and searching signatures with and without indexes of hot lookups"""
+        signatures = int(os.environ.get('BENCHMARK_SIGNATURES', 1_000_000))
+        with create_db_session() as session:
+            session.execute(text("INSERT INTO products (name, additional_content) "
+                                 "SELECT 'benchmark-' || g, '' FROM generate_series(1, 1000) g"))
+            first_product = session.execute(text("SELECT min(id) FROM products")).scalar()
+            session.execute(text("INSERT INTO signatures (license_key, additional_content, comment, product_id) "
+                                 "SELECT md5(g::text) || g, '', '', :first + g % 1000 "
+                                 "FROM generate_series(1, :n) g"), {"first": first_product, "n": signatures})
+            session.execute(text("INSERT INTO installations (fingerprint, signature_id) "
+                                 "SELECT md5(id::text), id FROM signatures"))
+            session.execute(text("UPDATE products SET sig_install_limit = 2"))
+            key, fingerprint = session.execute(text(
+                "SELECT s.license_key, i.fingerprint FROM signatures s JOIN installations i ON i.signature_id = s.id "
+                "ORDER BY s.id DESC LIMIT 1")).one()
+            session.commit()
+            session.execute(text("ANALYZE"))
+
+        def measure() -> dict[str, float]:
+            def check():
+                # Don't let cache hide database
+                lic_engine.license_cache.clear()
+                lic_engine.installations_cache.clear()
+                client.request('POST', '/check_license', json={"license_key": key, "fingerprint": fingerprint})
+            return {
+                "check_license": _measure(check, repeat=50),
+                "list_signatures": _measure(lambda: client.request(
+                    'GET', '/admin/list_signatures', params={"product_id": first_product, "limit": 100}, headers=auth),
+                    repeat=20),
+                "search_key_prefix": _measure(lambda: client.request(
+                    'GET', '/admin/search', params={"license_key": key[:8]}, headers=auth), repeat=20),
+                "search_fingerprint": _measure(lambda: client.request(
+                    'GET', '/admin/search', params={"fingerprint": fingerprint}, headers=auth), repeat=20),
+            }
+
+        indexed = measure()
+        with create_db_session() as session:
+            session.execute(text("ALTER TABLE installations DROP CONSTRAINT uq_installations_signature_id_fingerprint"))
+            session.execute(text("DROP INDEX ix_signatures_product_id"))
+            session.execute(text("DROP INDEX ix_signatures_license_key_pattern"))
+            session.execute(text("DROP INDEX ix_installations_fingerprint"))
+            session.commit()
+        not_indexed = measure()
+        for name, value in indexed.items():
+            print(f"\n{name} with {signatures} signatures: {value * 1000:.2f}ms with indexes, "
+                  f"{not_indexed[name] * 1000:.2f}ms without")
+            assert value < not_indexed[name]
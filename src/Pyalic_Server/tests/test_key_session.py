@@ -1,13 +1,20 @@
 """
 Test all about checking license key and interaction with sessions
 """
+import asyncio
 import time
+from contextlib import suppress
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.websockets import WebSocketDisconnect
 
-from ..app import config
+from ..app import config, db
 from ..app.db import models
+from ..app.licensing import write_behind, engine as lic_engine
 
 from . import rand_str, create_db_session
 
@@ -15,7 +22,7 @@ from . import rand_str, create_db_session
 # pylint: disable=C0116
 
 @pytest.mark.usefixtures('client', 'rebuild_db')
-class TestKeySession:  # pylint: disable=C0115
+class TestKeySession:  # pylint: disable=C0115,too-many-public-methods
     @staticmethod
     def __create_rand_product(inst_lim: int = None,
                               sessions_lim: int = None,
@@ -71,6 +78,49 @@ class TestKeySession:  # pylint: disable=C0115
         assert r.status_code == 200
         assert r.json()['success'] and r.json()['session_id']
 
+    def test_batch_keys(self, client):
+        """Check valid and invalid keys in one request"""
+        keys = [self.__create_rand_signature()[1] for _ in range(3)]
+        p = [{"license_key": key, "fingerprint": rand_str(16)} for key in keys + [rand_str(16)]]
+        r = client.request('POST', '/check_license/batch', json=p)
+        assert r.status_code == 200
+        assert [item['success'] for item in r.json()] == [True, True, True, False]
+        assert all(item['session_id'] for item in r.json()[:3])
+        assert r.json()[3] == {'error': 'Invalid license key', 'success': False}
+
+    def test_batch_limits(self, client):
+        """Limits must be applied to items of batch as if they were checked one by one"""
+        product_id = self.__create_rand_product(inst_lim=1, sessions_lim=2)
+        key = self.__create_rand_signature(product_id)[1]
+        fingerprint = rand_str(16)
+        p = [
+            {"license_key": key, "fingerprint": fingerprint},
+            {"license_key": key, "fingerprint": rand_str(16)},
+            {"license_key": key, "fingerprint": fingerprint},
+            {"license_key": key, "fingerprint": fingerprint},
+        ]
+        r = client.request('POST', '/check_license/batch', json=p)
+        assert r.status_code == 200
+        assert r.json()[0]['success'] and r.json()[2]['success']
+        assert r.json()[1] == {'error': 'Installations limit exceeded', 'success': False}
+        assert r.json()[3] == {'error': 'Sessions limit exceeded', 'success': False}
+
+    def test_batch_as_sequential_checks(self, client):
+        """Fingerprints of items denied because of sessions limit mustn't take installations from next items"""
+        product_id = self.__create_rand_product(inst_lim=2, sessions_lim=1)
+        fingerprints = [rand_str(16) for _ in range(3)]
+        fingerprints.append(fingerprints[0])
+        key = self.__create_rand_signature(product_id)[1]
+        sequential = [client.request('POST', '/check_license', json={"license_key": key, "fingerprint": f}).json()
+                      for f in fingerprints]
+        key = self.__create_rand_signature(product_id)[1]
+        r = client.request('POST', '/check_license/batch',
+                           json=[{"license_key": key, "fingerprint": f} for f in fingerprints])
+        assert r.status_code == 200
+        assert [(item['success'], item.get('error')) for item in r.json()] == \
+               [(item['success'], item.get('error')) for item in sequential] == \
+               [(True, None)] + [(False, 'Sessions limit exceeded')] * 3
+
     def test_immediately_end_session(self, client):
         """Create session by verifying key and immediately end it"""
         session_id = self.__create_rand_session(client)
@@ -96,6 +146,66 @@ class TestKeySession:  # pylint: disable=C0115
         assert r.status_code == 200
         assert r.json()['success']
 
+    def test_keepalive_batch(self, client):
+        """Keep-alive many sessions at once"""
+        session_ids = [self.__create_rand_session(client) for _ in range(3)]
+        client.request('POST', '/end_session', json={"session_id": session_ids[2]})
+        p = {
+            "session_ids": session_ids + [rand_str(32)]
+        }
+        for _ in range(2):
+            time.sleep(config.SESSION_ALIVE_PERIOD / 2)
+            r = client.request('POST', '/keepalive/batch', json=p)
+            assert r.status_code == 200
+            assert r.json()['sessions'] == {session_ids[0]: True, session_ids[1]: True, session_ids[2]: False,
+                                            p['session_ids'][3]: False}
+
+    def test_forged_session(self, client):
+        """Session ID of another signature can't be derived from a valid one"""
+        session_id = self.__create_rand_session(client)
+        signature_id, rest = session_id.split(":", 1)
+        p = {
+            "session_id": f"{int(signature_id) + 1}:{rest}"
+        }
+        r = client.request('POST', '/keepalive', json=p)
+        assert r.status_code == 404
+        r = client.request('POST', '/end_session', json=p)
+        assert r.status_code == 404
+
+    def test_non_ascii_session(self, client):
+        """Malformed Session ID with non-ASCII characters is just not found"""
+        session_id = self.__create_rand_session(client)
+        for malformed in ("1:0:abc:ü", "ü"):
+            r = client.request('POST', '/keepalive', json={"session_id": malformed})
+            assert r.status_code == 404
+            r = client.request('POST', '/end_session', json={"session_id": malformed})
+            assert r.status_code == 404
+            r = client.request('POST', '/keepalive/batch', json={"session_ids": [session_id, malformed]})
+            assert r.status_code == 200
+            assert r.json()['sessions'] == {session_id: True, malformed: False}
+
+    def test_websocket_keepalive(self, client):
+        """Keep session alive over WebSocket and end it by disconnecting"""
+        session_id = self.__create_rand_session(client)
+        p = {
+            "session_id": session_id
+        }
+        with client.websocket_connect(f"/session?session_id={session_id}") as ws:
+            for _ in range(3):
+                time.sleep(config.SESSION_ALIVE_PERIOD / 2)
+                ws.send_bytes(b"")
+            r = client.request('POST', '/keepalive', json=p)
+            assert r.status_code == 200
+        time.sleep(0.5)
+        r = client.request('POST', '/keepalive', json=p)
+        assert r.status_code == 404
+
+    def test_websocket_session_not_found(self, client):
+        with client.websocket_connect(f"/session?session_id={rand_str(32)}") as ws:
+            with pytest.raises(WebSocketDisconnect) as exc:
+                ws.receive_bytes()
+            assert exc.value.code == 4404
+
     def test_auto_end_session(self, client):
         """Create session and wait until it gets expired"""
         session_id = self.__create_rand_session(client)
@@ -150,6 +260,169 @@ class TestKeySession:  # pylint: disable=C0115
         assert r.status_code == 403
         assert r.json() == {'error': 'Sessions limit exceeded', 'success': False}
 
+    def test_limit_sessions_concurrent(self, client):
+        """Test that sessions limit holds when many checks of one key are processed at the same time"""
+        sessions_lim = 3
+        product_id = self.__create_rand_product(sessions_lim=sessions_lim)
+        key = self.__create_rand_signature(product_id)[1]
+        p = {
+            "license_key": key,
+            "fingerprint": rand_str(16)
+        }
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            responses = list(executor.map(lambda _: client.request('POST', '/check_license', json=p), range(64)))
+        assert len([r for r in responses if r.status_code == 200]) == sessions_lim
+        for r in responses:
+            if r.status_code != 200:
+                assert r.status_code == 403
+                assert r.json() == {'error': 'Sessions limit exceeded', 'success': False}
+
+    def test_limit_installations_concurrent(self, client):
+        """Test that installations limit holds when first checks from many machines are processed at the same time"""
+        inst_lim = 3
+        product_id = self.__create_rand_product(inst_lim=inst_lim)
+        signature_id, key = self.__create_rand_signature(product_id)
+
+        def check(_):
+            return client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            responses = list(executor.map(check, range(64)))
+        assert len([r for r in responses if r.status_code == 200]) == inst_lim
+        for r in responses:
+            if r.status_code != 200:
+                assert r.status_code == 403
+                assert r.json() == {'error': 'Installations limit exceeded', 'success': False}
+        with create_db_session() as session:
+            assert session.query(models.Installation).filter_by(signature_id=signature_id).count() == inst_lim
+            assert session.query(models.Signature).filter_by(id=signature_id).one().installations_count == inst_lim
+
+    @pytest.mark.parametrize("inst_lim", [None, 1])
+    def test_first_checks_of_one_fingerprint_concurrent(self, client, inst_lim):
+        """Test that simultaneous first checks from the same machine are all granted"""
+        product_id = self.__create_rand_product(inst_lim=inst_lim)
+        signature_id, key = self.__create_rand_signature(product_id)
+        p = {
+            "license_key": key,
+            "fingerprint": rand_str(16)
+        }
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            responses = list(executor.map(lambda _: client.request('POST', '/check_license', json=p), range(16)))
+        assert all(r.status_code == 200 for r in responses)
+        with create_db_session() as session:
+            assert session.query(models.Installation).filter_by(signature_id=signature_id).count() == 1
+
+    def test_write_behind(self, client, monkeypatch):
+        """Test that installations are reserved in redis and written to database by flush"""
+        monkeypatch.setattr(config, "WRITE_BEHIND", True)
+        product_id = self.__create_rand_product(inst_lim=1)
+        signature_id, key = self.__create_rand_signature(product_id)
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 200
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 403
+        assert r.json() == {'error': 'Installations limit exceeded', 'success': False}
+        with create_db_session() as session:
+            assert session.query(models.Installation).filter_by(signature_id=signature_id).count() == 0
+        assert client.portal.call(write_behind.flush_once, "tests") == 1
+        with create_db_session() as session:
+            assert session.query(models.Installation).filter_by(signature_id=signature_id).count() == 1
+            assert session.query(models.Signature).filter_by(id=signature_id).one().activation_date is not None
+
+    def test_write_behind_poisoned_entry(self, client, monkeypatch, redis_client):
+        """Malformed entry of queue mustn't stop installations from being written to database"""
+        monkeypatch.setattr(config, "WRITE_BEHIND", True)
+        monkeypatch.setattr(config, "WRITE_BEHIND_FLUSH_INTERVAL", 0.1)
+        signature_id, key = self.__create_rand_signature(self.__create_rand_product(inst_lim=1))
+        redis_client.xadd(write_behind.STREAM, {"signature_id": "poison"})
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 200
+        flush_once = write_behind.flush_once
+        calls = []
+
+        async def fail_once(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                raise KeyError("Unexpected")
+            return await flush_once(*args, **kwargs)
+
+        monkeypatch.setattr(write_behind, "flush_once", fail_once)
+
+        async def run_flusher() -> bool:
+            task = asyncio.create_task(write_behind.flush_forever())
+            await asyncio.sleep(1)
+            alive = not task.done()
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            return alive
+
+        assert client.portal.call(run_flusher) and len(calls) > 1
+        assert redis_client.xlen(write_behind.STREAM) == 0
+        with create_db_session() as session:
+            assert session.query(models.Installation).filter_by(signature_id=signature_id).count() == 1
+
+    def test_session_ended_if_registration_fails(self, client, monkeypatch):
+        """Session admitted before installation failed to be saved mustn't take place of signature"""
+        product_id = self.__create_rand_product(sessions_lim=1)
+        key = self.__create_rand_signature(product_id)[1]
+
+        async def fail(*_):
+            raise ConnectionError("Database is gone")
+
+        async def check():
+            async with AsyncSession(db.ENGINE) as session:
+                return await lic_engine.process_check_request(key, rand_str(16), session)
+
+        monkeypatch.setattr(lic_engine, "_register_installations", fail)
+        with pytest.raises(ConnectionError):
+            client.portal.call(check)
+        monkeypatch.undo()
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 200
+
+    def test_signature_invalidated_while_read(self, client):
+        """Signature read before it was invalidated mustn't be cached"""
+        signature_id, key = self.__create_rand_signature()
+        fingerprint = rand_str(16)
+
+        async def check_invalidated_meanwhile():
+            async with AsyncSession(db.ENGINE) as session:
+                execute = session.execute
+
+                async def execute_and_invalidate(*args, **kwargs):
+                    res = await execute(*args, **kwargs)
+                    await lic_engine.invalidate_signature(signature_id)
+                    return res
+
+                session.execute = execute_and_invalidate
+                return await lic_engine.process_check_request(key, fingerprint, session)
+
+        assert client.portal.call(check_invalidated_meanwhile).success
+        assert lic_engine.license_cache.get(key) is None
+        assert lic_engine.installations_cache.get((signature_id, fingerprint)) is None
+
+    def test_signature_read_from_lagging_replica(self, client):
+        """Signature read from replica mustn't be cached, as replica may replay its change after invalidation"""
+        signature_id, key = self.__create_rand_signature()
+        self.__create_rand_session(client, key)  # Activate signature
+
+        async def check_with_lagging_replica():
+            async with AsyncSession(db.ENGINE) as session, AsyncSession(db.ENGINE) as replica_session:
+                # Replica hasn't replayed deletion yet: its snapshot is taken before
+                await replica_session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+                await replica_session.execute(text("SELECT 1"))
+                with create_db_session() as db_session:
+                    db_session.query(models.Signature).filter_by(id=signature_id).delete()
+                    db_session.commit()
+                await lic_engine.invalidate_signature(signature_id)
+                return await lic_engine.process_check_request(key, rand_str(16), session, replica_session)
+
+        client.portal.call(check_with_lagging_replica)
+        assert lic_engine.license_cache.get(key) is None
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 403 and r.json()['error'] == 'Invalid license key'
+
     def test_signature_exp_after_activation(self, client):
         """Test the case when signature expires when session ended"""
         sig_period = 5
@@ -182,3 +455,21 @@ class TestKeySession:  # pylint: disable=C0115
         time.sleep(sig_period + 2)
         r = client.request('POST', '/keepalive', json={"session_id": r.json()['session_id']})
         assert r.status_code == 404
+
+    def test_limit_sessions_released(self, client):
+        """Test that ended and expired sessions aren't counted to sessions limit"""
+        product_id = self.__create_rand_product(sessions_lim=1)
+        key = self.__create_rand_signature(product_id)[1]
+        p = {
+            "license_key": key,
+            "fingerprint": rand_str(16)
+        }
+        r = client.request('POST', '/check_license', json=p)
+        assert r.status_code == 200
+        r = client.request('POST', '/end_session', json={"session_id": r.json()["session_id"]})
+        assert r.status_code == 200
+        r = client.request('POST', '/check_license', json=p)
+        assert r.status_code == 200
+        time.sleep(config.SESSION_ALIVE_PERIOD + 1)
+        r = client.request('POST', '/check_license', json=p)
+        assert r.status_code == 200
@@ -1,10 +1,17 @@
 """
 Test operations with products and all related to it
 """
+import asyncio
+import csv
+import io
+import json
+import re
+import time
 from dataclasses import dataclass
 import pytest
+from sqlalchemy import text
 
-from ..app import config
+from ..app import bulk, config, db, jobs
 from ..app.db import models
 
 from . import rand_str, create_db_session
@@ -45,7 +52,7 @@ def _create_rand_signature(product_id: int = None, license_key: str = None) -> i
 # pylint: disable=C0116
 
 @pytest.mark.usefixtures('client', 'rebuild_db', 'auth')
-class TestProductsOperations:
+class TestProductsOperations:  # pylint: disable=too-many-public-methods
     """
     Test operations with products
     """
@@ -231,6 +238,124 @@ class TestProductsOperations:
         r = client.request('DELETE', '/admin/product', params=p, headers=auth)
         assert r.status_code == 200 and r.json() == {'success': True}
 
+    def test_product_signatures_count(self, client, auth):
+        product_id = _create_rand_product().id
+        signature_ids = [_create_rand_signature(product_id) for _ in range(3)]
+        r = client.request('GET', '/admin/product', params={"id": product_id}, headers=auth)
+        assert r.status_code == 200 and r.json()['signatures'] == 3
+        r = client.request('DELETE', '/admin/signature', params={"id": signature_ids[0]}, headers=auth)
+        assert r.status_code == 200
+        r = client.request('GET', '/admin/list_products', params={"limit": 100, "offset": 0}, headers=auth)
+        assert r.status_code == 200
+        assert [p['signatures'] for p in r.json()['products'] if p['id'] == product_id] == [2]
+
+    def test_delete_product_in_background(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "DELETE_CHUNK_SIZE", 2)
+        product_id = _create_rand_product().id
+        for _ in range(5):
+            _create_rand_signature(product_id)
+        r = client.request('DELETE', '/admin/product', params={"id": product_id}, headers=auth)
+        assert r.status_code == 202 and r.json()['success']
+        # TestClient runs background tasks before returning response
+        r = client.request('GET', '/admin/job', params={"id": r.json()['job_id']}, headers=auth)
+        assert r.status_code == 200
+        assert r.json()['status'] == 'done' and r.json()['total'] == r.json()['done'] == 5
+        r = client.request('GET', '/admin/product', params={"id": product_id}, headers=auth)
+        assert r.status_code == 404
+
+    def test_get_job_not_exists(self, client, auth):
+        r = client.request('GET', '/admin/job', params={"id": rand_str(16)}, headers=auth)
+        assert r.status_code == 404 and r.json() == {'detail': 'Job not found'}
+
+    def test_get_job_of_other_user(self, client, auth):
+        job_id, _ = client.portal.call(jobs.create_job, "delete_product", 0, 1, 0)
+        with create_db_session() as session:
+            u = session.query(models.User).filter_by(username=config.DEFAULT_USER).one()
+            u.permissions = "manage_own_products"
+            session.commit()
+        r = client.request('GET', '/admin/job', params={"id": job_id}, headers=auth)
+        assert r.status_code == 404 and r.json() == {'detail': 'Job not found'}
+
+    def test_interrupted_job(self, client, auth, redis_client):
+        with create_db_session() as session:
+            user_id = session.query(models.User).filter_by(username=config.DEFAULT_USER).one().id
+        job_id, _ = client.portal.call(jobs.create_job, "delete_product", 0, 1, user_id)
+        r = client.request('GET', '/admin/job', params={"id": job_id}, headers=auth)
+        assert r.json()['status'] == 'running'
+        # Lease of target expires when worker running the job dies
+        redis_client.delete("running_job:delete_product:0")
+        r = client.request('GET', '/admin/job', params={"id": job_id}, headers=auth)
+        assert r.json()['status'] == 'failed'
+        job_id, created = client.portal.call(jobs.create_job, "delete_product", 0, 1, user_id)
+        assert created
+
+    def test_job_lease_outlives_slow_step(self, client, monkeypatch):
+        monkeypatch.setattr(jobs, "JOB_LEASE", 1)
+        job_id, _ = client.portal.call(jobs.create_job, "delete_product", 0, 1, 0)
+
+        async def slow_step() -> str:
+            async with jobs.holding_lease(job_id):
+                await asyncio.sleep(2.5)  # No progress is reported meanwhile
+                return (await jobs.get_job(job_id))["status"]
+
+        assert client.portal.call(slow_step) == "running"
+        assert client.portal.call(jobs.create_job, "delete_product", 0, 1, 0) == (job_id, False)
+
+    def test_update_product_applies_to_check_license(self, client, auth):
+        """Cached license data must be dropped when product is updated"""
+        product_id = _create_rand_product().id
+        key = rand_str(32)
+        _create_rand_signature(product_id, license_key=key)
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 200
+        r = client.request('PUT', '/admin/product', json={"sig_install_limit": 1}, params={'id': product_id},
+                           headers=auth)
+        assert r.status_code == 200
+        r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+        assert r.status_code == 403
+        assert r.json() == {'error': 'Installations limit exceeded', 'success': False}
+
+    def test_metrics(self, client, auth):
+        r = client.request('GET', '/admin/metrics', headers=auth)
+        assert r.status_code == 200
+        assert {'entries', 'size', 'hits', 'misses', 'evictions'} <= r.json()['license_cache'].keys()
+
+    def test_replica_lag_guard(self, client, auth, monkeypatch):
+        """Read-only handlers fall back to primary if replica lags behind (or isn't configured)"""
+        monkeypatch.setattr(config, "DB_REPLICA_LAG_CHECK_PERIOD", 0)
+        assert client.portal.call(db.replica_usable) == (config.DB_REPLICA_HOST is not None)
+        monkeypatch.setattr(config, "DB_REPLICA_MAX_LAG", -1)
+        assert not client.portal.call(db.replica_usable)
+        product_id = _create_rand_product().id
+        r = client.request('GET', '/admin/product', params={"id": product_id}, headers=auth)
+        assert r.status_code == 200 and r.json()['id'] == product_id
+
+    @pytest.mark.skipif(not config.DB_REPLICA_HOST, reason="Replica isn't configured")
+    def test_replica_heartbeat(self, client, monkeypatch):
+        """Replica stays usable while nothing but heartbeat is written to primary"""
+        monkeypatch.setattr(config, "DB_REPLICA_LAG_CHECK_PERIOD", 0)
+        time.sleep(config.DB_REPLICA_MAX_LAG * 2)
+        assert client.portal.call(db.replica_usable)
+
+    def test_single_heartbeat_writer(self, client, monkeypatch):
+        """Heartbeat is written by the only worker holding the lock, another one takes over when it's gone"""
+        monkeypatch.setattr(config, "DB_REPLICA_HEARTBEAT_PERIOD", 0.1)
+        holders = text("SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND granted "
+                       "AND (classid::bigint << 32 | objid::bigint) = :key")
+        workers = []
+        for _ in range(2):  # The first one takes the lock
+            workers.append(client.portal.start_task_soon(db.heartbeat_forever))
+            time.sleep(0.5)
+        with create_db_session() as session:
+            assert session.execute(holders, {"key": db.HEARTBEAT_LOCK}).scalar_one() == 1
+            beat_at = session.execute(text("SELECT beat_at FROM heartbeat")).scalar_one()
+        workers[0].cancel()
+        time.sleep(0.5)
+        with create_db_session() as session:
+            assert session.execute(holders, {"key": db.HEARTBEAT_LOCK}).scalar_one() == 1
+            assert session.execute(text("SELECT beat_at FROM heartbeat")).scalar_one() > beat_at
+        workers[1].cancel()
+
 
 class TestSignaturesOperations:
     """
@@ -260,6 +385,31 @@ class TestSignaturesOperations:
         assert r.json()['items'] == len(r.json()['signatures']) == 1
         assert r.json()['product_id'] == product_id
 
+    def test_list_signatures_cursor(self, client, auth):
+        product_id = _create_rand_product().id
+        signature_ids = [_create_rand_signature(product_id) for _ in range(5)]
+        p = {
+            "product_id": product_id,
+            "limit": 2
+        }
+        listed = []
+        for _ in range(3):
+            r = client.request('GET', '/admin/list_signatures', params=p, headers=auth)
+            assert r.status_code == 200 and r.json()['total'] == 5
+            listed += [sig['id'] for sig in r.json()['signatures']]
+            p['cursor'] = r.json().get('next_cursor')
+        assert listed == signature_ids and p['cursor'] is None
+        p = {
+            "product_id": product_id,
+            "after_id": signature_ids[3]
+        }
+        r = client.request('GET', '/admin/list_signatures', params=p, headers=auth)
+        assert [sig['id'] for sig in r.json()['signatures']] == signature_ids[4:]
+
+    def test_list_invalid_cursor(self, client, auth):
+        r = client.request('GET', '/admin/list_products', params={"cursor": "?"}, headers=auth)
+        assert r.status_code == 400 and r.json() == {'detail': 'Invalid cursor'}
+
     def test_add_signature_product_not_exists(self, client, auth):
         p = {
             "product_id": 0,
@@ -415,3 +565,266 @@ class TestSignaturesOperations:
         }
         r = client.request('DELETE', '/admin/signature', params=p, headers=auth)
         assert r.status_code == 200 and r.json() == {'success': True}
+
+    def test_signature_installations_count(self, client, auth):
+        key = rand_str(32)
+        signature_id = _create_rand_signature(license_key=key)
+        for _ in range(2):
+            r = client.request('POST', '/check_license', json={"license_key": key, "fingerprint": rand_str(16)})
+            assert r.status_code == 200
+        r = client.request('GET', '/admin/signature', params={"id": signature_id}, headers=auth)
+        assert r.status_code == 200 and r.json()['installed'] == 2
+
+    def test_delete_signature_applies_to_check_license(self, client, auth):
+        """Cached license data must be dropped when signature is deleted"""
+        key = rand_str(32)
+        signature_id = _create_rand_signature(license_key=key)
+        p = {
+            "license_key": key,
+            "fingerprint": rand_str(16)
+        }
+        r = client.request('POST', '/check_license', json=p)
+        assert r.status_code == 200
+        r = client.request('DELETE', '/admin/signature', params={"id": signature_id}, headers=auth)
+        assert r.status_code == 200
+        r = client.request('POST', '/check_license', json=p)
+        assert r.status_code == 403
+        assert r.json() == {'error': 'Invalid license key', 'success': False}
+
+
+class TestBulkOperations:
+    """
+    Test bulk operations with signatures
+    """
+
+    def test_import_signatures_csv(self, client, auth):
+        product_id = _create_rand_product().id
+        existing_key = rand_str(32)
+        _create_rand_signature(license_key=existing_key)
+        keys = [rand_str(32) for _ in range(3)]
+        content = (f'license_key,comment,activate\n{keys[0]},"multi\nline",yes\n{keys[1]},,\n'
+                   f'{existing_key},,\n{keys[0]},,\n{keys[2]},,maybe\n')
+        r = client.request('POST', '/admin/signature/import', params={"product_id": product_id},
+                           content=content.encode(), headers=auth)
+        assert r.status_code == 200
+        assert r.json()['imported'] == 2 and r.json()['conflicts'] == 2
+        assert sorted(r.json()['conflicting_keys']) == sorted([existing_key, keys[0]])
+        assert r.json()['invalid'] == 1 and r.json()['invalid_lines'] == [7]
+        with create_db_session() as session:
+            sig = session.query(models.Signature).filter_by(license_key=keys[0]).one()
+            assert sig.comment == "multi\nline" and sig.activation_date is not None
+            assert session.query(models.Product).filter_by(id=product_id).one().signatures_count == 2
+
+    def test_import_signatures_csv_with_bom(self, client, auth):
+        product_id = _create_rand_product().id
+        keys = [rand_str(32) for _ in range(2)]
+        content = "\ufefflicense_key,comment\r\n" + "".join(f"{key},ü\r\n" for key in keys)
+        r = client.request('POST', '/admin/signature/import', params={"product_id": product_id},
+                           content=content.encode(), headers=auth)
+        assert r.status_code == 200
+        assert r.json()['imported'] == 2 and r.json()['invalid'] == 0
+        with create_db_session() as session:
+            assert session.query(models.Signature).filter_by(license_key=keys[0]).one().comment == "ü"
+
+    def test_import_signatures_ndjson(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "IMPORT_CHUNK_SIZE", 2)
+        product_id = _create_rand_product().id
+        content = "\n".join(f'{{"license_key": "{rand_str(32)}", "additional_content": "content"}}' for _ in range(5))
+        r = client.request('POST', '/admin/signature/import', params={"product_id": product_id, "format": "ndjson"},
+                           content=content.encode(), headers=auth)
+        assert r.status_code == 200 and r.json()['imported'] == 5 and r.json()['conflicts'] == 0
+        assert r.json()['keys_per_second'] > 0
+
+    def test_generate_signatures(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "IMPORT_CHUNK_SIZE", 2)
+        product_id = _create_rand_product().id
+        p = {
+            "product_id": product_id,
+            "count": 5,
+            "key_format": "KEY-XXXXXXXX-XXXXXXXX"
+        }
+        r = client.request('POST', '/admin/signature/generate', json=p, headers=auth)
+        assert r.status_code == 200
+        keys = r.text.splitlines()
+        assert len(set(keys)) == 5 and all(re.fullmatch(r"KEY-[A-Z2-9]{8}-[A-Z2-9]{8}", key) for key in keys)
+        with create_db_session() as session:
+            assert session.query(models.Product).filter_by(id=product_id).one().signatures_count == 5
+
+    def test_generate_signatures_exhausted_format(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "IMPORT_CHUNK_SIZE", 2)
+        key = rand_str(32)
+        # Every key collides with the first one
+        monkeypatch.setattr(bulk, "generate_key", lambda _: key)
+        p = {
+            "product_id": _create_rand_product().id,
+            "count": 5,
+            "key_format": "KEY-XXXXXXXX-XXXXXXXX"
+        }
+        r = client.request('POST', '/admin/signature/generate', json=p, headers=auth)
+        assert r.status_code == 200
+        lines = r.text.splitlines()
+        assert lines[0] == key
+        assert lines[1] == "ERROR: Generated 1 of 5 signatures, no more unique keys of this format"
+
+    def test_generate_signatures_database_failure(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "IMPORT_CHUNK_SIZE", 2)
+        merge_chunk = bulk._merge_chunk  # pylint: disable=protected-access
+        calls = []
+
+        async def failing_merge_chunk(rows, product_id, session):
+            calls.append(rows)
+            if len(calls) > 1:  # Fails on the second chunk
+                raise OSError("Connection lost")
+            return await merge_chunk(rows, product_id, session)
+
+        monkeypatch.setattr(bulk, "_merge_chunk", failing_merge_chunk)
+        p = {
+            "product_id": _create_rand_product().id,
+            "count": 5,
+            "key_format": "KEY-XXXXXXXX-XXXXXXXX"
+        }
+        r = client.request('POST', '/admin/signature/generate', json=p, headers=auth)
+        assert r.status_code == 200
+        lines = r.text.splitlines()
+        assert len(lines) == 3
+        assert lines[-1] == "ERROR: Generated 2 of 5 signatures, generation failed"
+
+    def test_generate_signatures_guessable_format(self, client, auth):
+        p = {
+            "product_id": _create_rand_product().id,
+            "count": 1,
+            "key_format": "KEY-XXXX"
+        }
+        r = client.request('POST', '/admin/signature/generate', json=p, headers=auth)
+        assert r.status_code == 400 and r.json() == {'detail': 'Key format has too few random characters'}
+
+    def test_export_signatures(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "EXPORT_FETCH_SIZE", 2)
+        product_id = _create_rand_product().id
+        signature_ids = [_create_rand_signature(product_id) for _ in range(3)]
+        with create_db_session() as session:
+            session.add(models.Installation(fingerprint=rand_str(16), signature_id=signature_ids[0]))
+            session.commit()
+        r = client.request('GET', '/admin/export/signatures', params={"product_id": product_id}, headers=auth)
+        assert r.status_code == 200 and r.headers['content-type'].startswith('text/csv')
+        rows = list(csv.DictReader(io.StringIO(r.text)))
+        assert [int(row['id']) for row in rows] == signature_ids
+        assert [int(row['installed']) for row in rows] == [1, 0, 0]
+
+    def test_export_signatures_failure(self, client, auth, monkeypatch):
+        monkeypatch.setattr(config, "EXPORT_FETCH_SIZE", 2)
+        product_id = _create_rand_product().id
+        for _ in range(3):
+            _create_rand_signature(product_id)
+        format_rows = bulk._format_rows  # pylint: disable=protected-access
+        calls = []
+
+        def failing_format_rows(rows, keys, fmt):
+            calls.append(rows)
+            if len(calls) > 1:  # Fails on the second chunk of rows
+                raise RuntimeError("Connection lost")
+            return format_rows(rows, keys, fmt)
+
+        monkeypatch.setattr(bulk, "_format_rows", failing_format_rows)
+        p = {
+            "product_id": product_id,
+            "format": "ndjson"
+        }
+        r = client.request('GET', '/admin/export/signatures', params=p, headers=auth)
+        assert r.status_code == 200
+        lines = [json.loads(line) for line in r.text.splitlines()]
+        assert len(lines) == 3 and lines[-1] == {"error": "Export failed after 2 rows"}
+        calls.clear()
+        r = client.request('GET', '/admin/export/signatures', params={"product_id": product_id}, headers=auth)
+        assert r.status_code == 200
+        assert r.text.splitlines()[-1] == f"{bulk.STREAM_ERROR}Export failed after 0 rows"
+
+    def test_export_installations_and_users(self, client, auth):
+        signature_id = _create_rand_signature()
+        with create_db_session() as session:
+            fingerprint = rand_str(16)
+            session.add(models.Installation(fingerprint=fingerprint, signature_id=signature_id))
+            product_id = session.query(models.Signature).filter_by(id=signature_id).one().product_id
+            session.commit()
+        p = {
+            "product_id": product_id,
+            "format": "ndjson"
+        }
+        r = client.request('GET', '/admin/export/installations', params=p, headers=auth)
+        assert r.status_code == 200
+        rows = [json.loads(line) for line in r.text.splitlines()]
+        assert [(row['signature_id'], row['fingerprint']) for row in rows] == [(signature_id, fingerprint)]
+        r = client.request('GET', '/admin/export/users', params={"format": "ndjson"}, headers=auth)
+        assert r.status_code == 200
+        assert config.DEFAULT_USER in [json.loads(line)['username'] for line in r.text.splitlines()]
+
+
+@pytest.mark.usefixtures('client', 'rebuild_db', 'auth')
+class TestSearchSignatures:
+    """
+    Test search of signatures
+    """
+
+    def test_search_by_key_prefix(self, client, auth):
+        product_id = _create_rand_product().id
+        prefix = rand_str(8)
+        ids = {_create_rand_signature(product_id, prefix + rand_str(16)) for _ in range(3)}
+        _create_rand_signature(product_id, rand_str(8) + prefix)
+        r = client.request('GET', '/admin/search', params={"license_key": prefix}, headers=auth)
+        assert r.status_code == 200
+        assert {sig['id'] for sig in r.json()['signatures']} == ids
+        assert all(sig['license_key'].startswith(prefix) for sig in r.json()['signatures'])
+
+    def test_search_by_key_prefix_wildcards(self, client, auth):
+        product_id = _create_rand_product().id
+        prefix = rand_str(8)
+        sig_id = _create_rand_signature(product_id, prefix + "%_" + rand_str(8))
+        _create_rand_signature(product_id, prefix + rand_str(8))
+        r = client.request('GET', '/admin/search', params={"license_key": prefix + "%_"}, headers=auth)
+        assert [sig['id'] for sig in r.json()['signatures']] == [sig_id]
+
+    def test_search_by_comment(self, client, auth):
+        product_id = _create_rand_product().id
+        word = rand_str(8)
+        with create_db_session() as session:
+            s = models.Signature(license_key=rand_str(32), product_id=product_id,
+                                 comment=f"Bought by {word.upper()} in store")
+            session.add_all([s, models.Signature(license_key=rand_str(32), product_id=product_id, comment="")])
+            session.commit()
+            sig_id = s.id
+        r = client.request('GET', '/admin/search', params={"comment": word.lower()}, headers=auth)
+        assert r.status_code == 200
+        assert [sig['id'] for sig in r.json()['signatures']] == [sig_id]
+
+    def test_search_by_fingerprint(self, client, auth):
+        sig_id = _create_rand_signature()
+        fingerprint = rand_str(16)
+        with create_db_session() as session:
+            session.add(models.Installation(signature_id=sig_id, fingerprint=fingerprint))
+            session.commit()
+        r = client.request('GET', '/admin/search', params={"fingerprint": fingerprint}, headers=auth)
+        assert r.status_code == 200
+        assert [sig['id'] for sig in r.json()['signatures']] == [sig_id]
+        r = client.request('GET', '/admin/search', params={"fingerprint": rand_str(16)}, headers=auth)
+        assert r.json()['signatures'] == [] and r.json()['items'] == 0
+
+    def test_search_cursor(self, client, auth):
+        product_id = _create_rand_product().id
+        prefix = rand_str(8)
+        ids = sorted(_create_rand_signature(product_id, prefix + rand_str(16)) for _ in range(5))
+        found = []
+        p = {"license_key": prefix, "product_id": product_id, "limit": 2}
+        while True:
+            r = client.request('GET', '/admin/search', params=p, headers=auth)
+            assert r.status_code == 200
+            found += [sig['id'] for sig in r.json()['signatures']]
+            if r.json()['next_cursor'] is None:
+                break
+            p["cursor"] = r.json()['next_cursor']
+        assert found == ids
+
+    def test_search_invalid_criteria(self, client, auth):
+        r = client.request('GET', '/admin/search', headers=auth)
+        assert r.status_code == 400
+        r = client.request('GET', '/admin/search', params={"comment": "ab"}, headers=auth)
+        assert r.status_code == 422
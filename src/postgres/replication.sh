@@ -0,0 +1,9 @@
+#!/bin/sh
+# Init script of primary PostgreSQL with a streaming replica (see docker-compose.tests.yml).
+# Commits wait until replica applies them, so handlers reading from replica always see previous writes
+set -e
+
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
+psql -v ON_ERROR_STOP=1 -U "$POSTGRES_USER" -d "$POSTGRES_DB" \
+  -c "ALTER SYSTEM SET synchronous_standby_names = '*'" \
+  -c "ALTER SYSTEM SET synchronous_commit = 'remote_apply'"